@@ -0,0 +1,83 @@
+# Measures hashing throughput of organize_files_by_checksum for different worker counts on a synthetic corpus.
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from file_handler import get_files_in_directory, organize_files_by_checksum
+
+def create_corpus(directory, file_count, file_size, duplicate_every=2):
+    """
+    Create a corpus of random files where every duplicate_every-th file is a copy of the previous one.
+
+    All files have the same size so that every file reaches the full hash stage.
+    """
+    previous = None
+    for index in range(file_count):
+        file_path = os.path.join(directory, f"file_{index:05d}.bin")
+        if previous is not None and index % duplicate_every == 0:
+            shutil.copyfile(previous, file_path)
+        else:
+            with open(file_path, 'wb') as f:
+                f.write(os.urandom(file_size))
+        previous = file_path
+
+def run_benchmark(files, worker_counts, use_processes=False, read_size=None):
+    """Hash the corpus once per worker count and return (workers, seconds, MB/s) rows."""
+    options = {"use_processes": use_processes}
+    if read_size:
+        options["read_size"] = read_size
+
+    results = []
+    baseline = None
+    for workers in worker_counts:
+        stats = {}
+        start = time.perf_counter()
+        checksum_dict = organize_files_by_checksum(files, stats, workers=workers, **options)
+        elapsed = time.perf_counter() - start
+
+        # Every worker count must produce exactly the same groups
+        if baseline is None:
+            baseline = checksum_dict
+        elif checksum_dict != baseline:
+            raise RuntimeError(f"Result with {workers} workers differs from the first run")
+
+        bytes_read = sum(stage["bytes_read"] for stage in stats.values())
+        results.append((workers, elapsed, bytes_read / elapsed / (1024 * 1024)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DDAS hashing throughput.")
+    parser.add_argument("--files", type=int, default=64, help="number of files in the corpus")
+    parser.add_argument("--size-mb", type=float, default=16, help="size of each file in MB")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="worker counts to test")
+    parser.add_argument("--processes", action="store_true", help="use a process pool instead of threads")
+    parser.add_argument("--read-size", type=int, help="read size in bytes for the full hash stage")
+    parser.add_argument("--directory", help="existing directory to hash instead of a synthetic corpus")
+    args = parser.parse_args()
+
+    temp_dir = None
+    directory = args.directory
+    if directory is None:
+        temp_dir = tempfile.mkdtemp(prefix="ddas_bench_")
+        directory = temp_dir
+        print(f"Creating {args.files} files of {args.size_mb} MB in {directory}...")
+        create_corpus(directory, args.files, int(args.size_mb * 1024 * 1024))
+
+    try:
+        files = get_files_in_directory(directory)
+        # Warm the page cache so that every run measures the same thing
+        organize_files_by_checksum(files, workers=1)
+
+        print(f"{'workers':>8} {'seconds':>10} {'MB/s':>10} {'speedup':>8}")
+        results = run_benchmark(files, args.workers, args.processes, args.read_size)
+        base_time = results[0][1]
+        for workers, elapsed, throughput in results:
+            print(f"{workers:>8} {elapsed:>10.3f} {throughput:>10.1f} {base_time / elapsed:>7.2f}x")
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
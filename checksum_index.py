@@ -0,0 +1,157 @@
+# Stores file checksums in an SQLite database so that unchanged files are not hashed again on the next scan.
+
+import os
+import sqlite3
+
+DEFAULT_INDEX_PATH = 'checksum_index.db'
+
+# Bumped whenever the table layout changes; an index with another version is rebuilt
+SCHEMA_VERSION = 3
+
+class ChecksumIndex:
+    """
+    On-disk cache of partial and full checksums.
+
+    Entries are keyed by (device, inode) and are only reused while the file's
+    size, modification time and status change time (in nanoseconds) are
+    unchanged. The ctime cannot be set from user space, so a file that was
+    modified and had its mtime restored is still hashed again. A file moved
+    along with its directory keeps its cached checksums; a replaced or
+    modified file gets a new inode, mtime or ctime and is hashed again.
+
+    Every scan gets its own scan id. Entries written or reused during the scan
+    are stamped with it, so prune() can drop entries for files that are gone.
+
+    Checksums are stored per hash algorithm, so one index can serve scans
+    with different algorithms.
+    """
+
+    def __init__(self, db_path=DEFAULT_INDEX_PATH, algorithm="md5"):
+        self.db_path = db_path
+        self.algorithm = algorithm
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # The index is only a cache, so an old layout is simply dropped
+            self.connection.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS scans;")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                algorithm TEXT NOT NULL,
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                ctime_ns INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                partial TEXT,
+                full TEXT,
+                scan_id INTEGER NOT NULL,
+                PRIMARY KEY (algorithm, dev, ino)
+            );
+            CREATE INDEX IF NOT EXISTS files_path ON files (path);
+            CREATE TABLE IF NOT EXISTS scans (
+                scan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started REAL NOT NULL DEFAULT (julianday('now'))
+            );
+        """)
+        self.scan_id = self.connection.execute("INSERT INTO scans DEFAULT VALUES").lastrowid
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, entry):
+        """
+        Return the cached (partial, full) checksums of a file.
+
+        Parameters:
+            entry (FileEntry): The file's path and stat data.
+
+        Returns:
+            tuple: (partial, full), where either value may be None if it was
+            never computed. (None, None) if the file is unknown or changed.
+        """
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, ctime_ns, partial, full FROM files WHERE algorithm = ? AND dev = ? AND ino = ?",
+            (self.algorithm, entry.dev, entry.inode),
+        ).fetchone()
+        if row is None or row[:3] != (entry.size, entry.mtime_ns, entry.ctime_ns):
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return row[3], row[4]
+
+    def store_many(self, rows):
+        """
+        Store checksums for several files and mark them as seen in this scan.
+
+        Parameters:
+            rows (iterable): (entry, partial, full) tuples. A None checksum keeps
+                the cached value if the file is unchanged.
+        """
+        self.connection.executemany(
+            """
+            INSERT INTO files (algorithm, dev, ino, size, mtime_ns, ctime_ns, path, partial, full, scan_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (algorithm, dev, ino) DO UPDATE SET
+                path = excluded.path,
+                partial = CASE WHEN files.size = excluded.size AND files.mtime_ns = excluded.mtime_ns
+                               AND files.ctime_ns = excluded.ctime_ns
+                               THEN COALESCE(excluded.partial, files.partial) ELSE excluded.partial END,
+                full = CASE WHEN files.size = excluded.size AND files.mtime_ns = excluded.mtime_ns
+                               AND files.ctime_ns = excluded.ctime_ns
+                            THEN COALESCE(excluded.full, files.full) ELSE excluded.full END,
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                ctime_ns = excluded.ctime_ns,
+                scan_id = excluded.scan_id
+            """,
+            (
+                (self.algorithm, entry.dev, entry.inode, entry.size, entry.mtime_ns, entry.ctime_ns,
+                 os.path.abspath(entry.path), partial, full, self.scan_id)
+                for entry, partial, full in rows
+            ),
+        )
+        self.connection.commit()
+
+    def prune(self, roots=None):
+        """
+        Delete entries that were not seen during the current scan.
+
+        Parameters:
+            roots (list, optional): Only prune entries below these directories,
+                so that one index can be shared by scans of different trees.
+                If None, every entry not seen in this scan is deleted.
+
+        Returns:
+            int: The number of entries deleted.
+        """
+        if roots is None:
+            cursor = self.connection.execute("DELETE FROM files WHERE algorithm = ? AND scan_id != ?",
+                                             (self.algorithm, self.scan_id))
+            deleted = cursor.rowcount
+        else:
+            deleted = 0
+            for root in roots:
+                prefix = os.path.join(os.path.abspath(root), '')
+                # Paths below root sort between "root/" and the next possible prefix
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                cursor = self.connection.execute(
+                    "DELETE FROM files WHERE algorithm = ? AND scan_id != ? AND path >= ? AND path < ?",
+                    (self.algorithm, self.scan_id, prefix, upper),
+                )
+                deleted += cursor.rowcount
+        self.connection.commit()
+        return deleted
+
+    def close(self):
+        """Commit pending changes and close the database."""
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,308 @@
+# Splits files into content-defined chunks (FastCDC) to measure how much data files share below the file level.
+
+import hashlib
+from array import array
+from itertools import combinations
+from file_handler import FileEntry, stat_file
+
+try:
+    import numpy  # Optional, vectorizes the rolling hash
+except ImportError:
+    numpy = None
+
+# Chunk size limits in bytes; chunks average about DEFAULT_AVG_CHUNK bytes
+DEFAULT_MIN_CHUNK = 2 * 1024
+DEFAULT_AVG_CHUNK = 8 * 1024
+DEFAULT_MAX_CHUNK = 64 * 1024
+
+# Bytes of a file that are read and cut at a time, so memory stays bounded for any file size.
+# The hash arrays of a window are eight times its size, so a small window stays in cache.
+DEFAULT_WINDOW_SIZE = 1024 * 1024
+
+# Chunks found in more files than this count toward the totals, but not toward the file pairs
+DEFAULT_MAX_PAIR_FILES = 32
+
+# Size of a chunk digest in bytes
+CHUNK_DIGEST_SIZE = 16
+
+MASK_64 = (1 << 64) - 1
+
+def _gear_table():
+    """Return the 256 fixed pseudo-random 64-bit values of the gear hash."""
+    return [int.from_bytes(hashlib.blake2b(bytes([value]), digest_size=8, person=b'ddas-gear').digest(), 'little')
+            for value in range(256)]
+
+GEAR = _gear_table()
+_GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+def _masks(avg_size):
+    """
+    Return the (small, large) cut masks for normalized chunking.
+
+    Below the average size a cut needs two more zero bits than the average
+    would, above it two fewer, which pulls chunk sizes towards the average.
+    The high bits are used because bit k of the gear hash depends on the last
+    k + 1 bytes only.
+    """
+    bits = avg_size.bit_length() - 1
+    mask_small = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    mask_large = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    return mask_small, mask_large
+
+def _gear_hashes(data):
+    """
+    Return the gear hash at every position of data as a NumPy array.
+
+    The hash at position i is the sum of GEAR[data[i - k]] << k for k < 64,
+    so it can be built from 64-byte windows in six doubling steps instead of
+    a byte-by-byte loop. Bytes before the start of data count as zero.
+    """
+    hashes = _GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    span = 1
+    while span < 64:
+        # The shifted copy is made before the in-place add, so this reads the previous step only
+        hashes[span:] += hashes[:-span] << numpy.uint64(span)
+        span *= 2
+    return hashes
+
+def _find_cuts_numpy(data, min_size, avg_size, max_size, final):
+    mask_small, mask_large = _masks(avg_size)
+    hashes = _gear_hashes(data)
+    small = numpy.flatnonzero((hashes & numpy.uint64(mask_small)) == 0)
+    large = numpy.flatnonzero((hashes & numpy.uint64(mask_large)) == 0)
+    length = len(data)
+    cuts = []
+    start = 0
+    while start < length:
+        lowest, middle, highest = start + min_size - 1, start + avg_size - 1, start + max_size - 1
+        position = numpy.searchsorted(small, lowest)
+        if position < len(small) and small[position] < middle:
+            cut = int(small[position]) + 1
+        else:
+            position = numpy.searchsorted(large, middle)
+            if position < len(large) and large[position] < highest:
+                cut = int(large[position]) + 1
+            elif highest < length:
+                cut = highest + 1
+            elif final:
+                cut = length
+            else:
+                break
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+def _find_cuts_python(data, min_size, avg_size, max_size, final):
+    mask_small, mask_large = _masks(avg_size)
+    length = len(data)
+    cuts = []
+    start = 0
+    while start < length:
+        middle, highest = start + avg_size - 1, start + max_size - 1
+        cut = None
+        # The first min_size bytes of a chunk are never a cut point; only the 64 before it matter
+        gear_hash = 0
+        for position in range(start + min_size - 64, min(highest + 1, length)):
+            gear_hash = ((gear_hash << 1) + GEAR[data[position]]) & MASK_64
+            if position < start + min_size - 1:
+                continue
+            if position < middle:
+                if not gear_hash & mask_small:
+                    cut = position + 1
+                    break
+            elif position < highest:
+                if not gear_hash & mask_large:
+                    cut = position + 1
+                    break
+            else:
+                cut = position + 1
+                break
+        if cut is None:
+            if not final:
+                break
+            cut = length
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+def find_cut_points(data, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK, max_size=DEFAULT_MAX_CHUNK,
+                    final=True):
+    """
+    Return the end offsets of the content-defined chunks of data.
+
+    Uses the FastCDC gear hash with normalized chunking: a chunk ends at the
+    first position, at least min_size bytes in, where the hash has enough zero
+    bits, and never later than max_size bytes in. The hash only covers bytes of
+    the current chunk, so the same content is cut the same way wherever it is
+    in a file. NumPy is used when it is installed; the result is identical
+    without it.
+
+    Parameters:
+        data (bytes-like): The bytes to cut, starting at a chunk boundary.
+        min_size, avg_size, max_size (int): Chunk size limits. avg_size must
+            be a power of two and min_size at least 64.
+        final (bool): If True, data ends the file and the last offset is
+            len(data). If False, bytes after the last cut that is certain
+            are left for the next call.
+
+    Returns:
+        list: Increasing end offsets of the chunks.
+    """
+    if min_size < 64 or not min_size <= avg_size <= max_size or avg_size & (avg_size - 1):
+        raise ValueError("Chunk sizes must satisfy 64 <= min_size <= avg_size <= max_size, "
+                         "with avg_size a power of two")
+    if numpy is not None:
+        return _find_cuts_numpy(data, min_size, avg_size, max_size, final)
+    return _find_cuts_python(data, min_size, avg_size, max_size, final)
+
+def generate_chunks(file_path, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK, max_size=DEFAULT_MAX_CHUNK,
+                    window_size=DEFAULT_WINDOW_SIZE):
+    """
+    Yield (digest, length) for each content-defined chunk of a file.
+
+    The file is read window_size bytes at a time, and only the bytes after the
+    last cut are carried into the next window, so memory use does not depend
+    on the size of the file. Digests are BLAKE2b with CHUNK_DIGEST_SIZE bytes.
+    """
+    carry = b""
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(window_size)
+            final = not block
+            data = carry + block
+            view = memoryview(data)
+            previous = 0
+            for cut in find_cut_points(data, min_size, avg_size, max_size, final):
+                yield hashlib.blake2b(view[previous:cut], digest_size=CHUNK_DIGEST_SIZE).digest(), cut - previous
+                previous = cut
+            view.release()
+            carry = data[previous:]
+            if final:
+                return
+
+class ChunkIndex:
+    """
+    Index of chunk digests across a set of files.
+
+    Every distinct chunk is stored once, as an id with its size and the last
+    file that referenced it. Only chunks that turn up in a second file get a
+    list of files, so the index stays small when most content is unique.
+    """
+
+    def __init__(self, min_size=DEFAULT_MIN_CHUNK, avg_size=DEFAULT_AVG_CHUNK, max_size=DEFAULT_MAX_CHUNK,
+                 window_size=DEFAULT_WINDOW_SIZE):
+        self.chunk_options = (min_size, avg_size, max_size, window_size)
+        self.paths = []
+        self.file_sizes = array('Q')
+        self._chunk_ids = {}
+        self._chunk_sizes = array('L')
+        self._chunk_last_file = array('l')
+        self._shared_chunks = {}    # chunk id -> file ids, for chunks in more than one file
+        self.total_bytes = 0
+        self.chunk_count = 0
+
+    def add_file(self, file_path):
+        """Chunk a file and add its chunks to the index. Returns the file id."""
+        file_id = len(self.paths)
+        self.paths.append(file_path)
+        file_size = 0
+        try:
+            for digest, length in generate_chunks(file_path, *self.chunk_options):
+                file_size += length
+                self.chunk_count += 1
+                chunk_id = self._chunk_ids.get(digest)
+                if chunk_id is None:
+                    self._chunk_ids[digest] = len(self._chunk_sizes)
+                    self._chunk_sizes.append(length)
+                    self._chunk_last_file.append(file_id)
+                    continue
+                last_file = self._chunk_last_file[chunk_id]
+                if last_file == file_id:
+                    continue  # Repeated within the same file
+                self._chunk_last_file[chunk_id] = file_id
+                self._shared_chunks.setdefault(chunk_id, [last_file]).append(file_id)
+        finally:
+            # A file that fails part way keeps the chunks read so far
+            self.file_sizes.append(file_size)
+            self.total_bytes += file_size
+        return file_id
+
+    @property
+    def unique_bytes(self):
+        """The bytes left if every distinct chunk was stored once."""
+        return sum(self._chunk_sizes)
+
+    def summary(self):
+        """Return the corpus totals as a dictionary."""
+        unique_bytes = self.unique_bytes
+        return {
+            "files": len(self.paths),
+            "total_bytes": self.total_bytes,
+            "unique_bytes": unique_bytes,
+            "shared_bytes": self.total_bytes - unique_bytes,
+            "dedup_ratio": round(self.total_bytes / unique_bytes, 4) if unique_bytes else None,
+            "chunks": self.chunk_count,
+            "unique_chunks": len(self._chunk_sizes),
+        }
+
+    def file_shared_bytes(self):
+        """Return {path: bytes of distinct chunks the file shares with at least one other file}."""
+        shared = {}
+        for chunk_id, file_ids in self._shared_chunks.items():
+            for file_id in file_ids:
+                shared[self.paths[file_id]] = shared.get(self.paths[file_id], 0) + self._chunk_sizes[chunk_id]
+        return shared
+
+    def groups(self):
+        """
+        Return (paths, shared_bytes) for every set of files that has chunks in common.
+
+        Chunks are grouped by the exact set of files containing them, largest
+        groups (by shared bytes) first.
+        """
+        groups = {}
+        for chunk_id, file_ids in self._shared_chunks.items():
+            key = tuple(file_ids)
+            groups[key] = groups.get(key, 0) + self._chunk_sizes[chunk_id]
+        return sorted((([self.paths[file_id] for file_id in file_ids], shared_bytes)
+                       for file_ids, shared_bytes in groups.items()),
+                      key=lambda group: -group[1])
+
+    def pairs(self, max_files=DEFAULT_MAX_PAIR_FILES):
+        """
+        Return (path_a, path_b, shared_bytes) for every pair of files with chunks in common, largest first.
+
+        Chunks found in more than max_files files (such as blocks of zeros)
+        are left out, because they would add a pair for every combination.
+        """
+        pairs = {}
+        for chunk_id, file_ids in self._shared_chunks.items():
+            if len(file_ids) > max_files:
+                continue
+            size = self._chunk_sizes[chunk_id]
+            for pair in combinations(file_ids, 2):
+                pairs[pair] = pairs.get(pair, 0) + size
+        return sorted(((self.paths[a], self.paths[b], shared_bytes) for (a, b), shared_bytes in pairs.items()),
+                      key=lambda pair: -pair[2])
+
+def analyze_files(files, **chunk_options):
+    """
+    Chunk every file and return the ChunkIndex.
+
+    files may be paths or FileEntry records (which are not stat'ed again).
+    Extra names of a hard-linked inode are skipped, and files that cannot be
+    read are left out.
+    """
+    index = ChunkIndex(**chunk_options)
+    seen_inodes = set()
+    for file in files:
+        try:
+            entry = file if isinstance(file, FileEntry) else stat_file(file)
+            if entry.nlink > 1:
+                if (entry.dev, entry.inode) in seen_inodes:
+                    continue
+                seen_inodes.add((entry.dev, entry.inode))
+            index.add_file(entry.path)
+        except OSError:
+            continue
+    return index
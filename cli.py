@@ -0,0 +1,316 @@
+# Non-interactive command-line interface for running DDAS from cron jobs, scripts or containers.
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from file_handler import scan_directory, organize_files_by_checksum, ScanCancelled, DEFAULT_WORKERS
+from ddas import (build_removal_plan, write_removal_plan, read_removal_plan, execute_removal_plan, RemovalResult,
+                  KEEP_POLICIES, DEFAULT_REMOVAL_WORKERS)
+from checksum_index import ChecksumIndex, DEFAULT_INDEX_PATH
+from tree_hash import find_duplicate_directories
+from watcher import DuplicateWatcher, DEFAULT_DEBOUNCE
+from chunking import analyze_files, DEFAULT_AVG_CHUNK
+from logger import setup_logger
+
+# Hash algorithms offered on the command line (all are guaranteed by hashlib)
+HASH_ALGORITHMS = ("md5", "sha1", "sha256", "sha512", "blake2b", "blake2s")
+
+DELETION_MODES = ("trash", "permanent", "link")
+
+def parse_args(argv=None):
+    """Parse the command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Find duplicate files and remove them without the interactive menu. "
+                    "Duplicate groups are written as JSON Lines while the scan runs, "
+                    "followed by a summary record.")
+    parser.add_argument("roots", nargs="*", help="directories to scan")
+    parser.add_argument("--algorithm", choices=HASH_ALGORITHMS, default="md5", help="hash algorithm (default: md5)")
+    parser.add_argument("--mode", choices=DELETION_MODES, default="trash", help="deletion mode (default: trash)")
+    parser.add_argument("--dry-run", action="store_true", help="report duplicates without removing anything")
+    parser.add_argument("--keep", choices=KEEP_POLICIES, default="first", help="which file of a group is kept")
+    parser.add_argument("--preferred-root", help="directory whose files are kept with --keep root")
+    parser.add_argument("--output", default="-", help="JSON Lines report file (default: stdout)")
+    parser.add_argument("--plan-file", help="write the removal plan to this file")
+    parser.add_argument("--journal", help="journal file that makes an interrupted removal resumable")
+    parser.add_argument("--execute-plan", metavar="PLAN_FILE",
+                        help="carry out a plan written by --plan-file or a dry run instead of scanning")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="checksum index database")
+    parser.add_argument("--no-index", action="store_true", help="hash every file, do not use the checksum index")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of hashing workers")
+    parser.add_argument("--processes", action="store_true", help="hash in a process pool instead of threads")
+    parser.add_argument("--removal-workers", type=int, default=DEFAULT_REMOVAL_WORKERS,
+                        help="number of removal workers")
+    parser.add_argument("--exclude", action="append", default=[], help="directory name or path to skip")
+    parser.add_argument("--min-size", type=int, default=0, help="skip files smaller than this many bytes")
+    parser.add_argument("--no-directories", action="store_true",
+                        help="only compare files, do not look for identical directory trees")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep files and duplicate groups in compact arrays (for very large trees); "
+                             "implies --no-directories")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and handle duplicates of new files as they arrive (Linux)")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                        help="seconds a new file must be untouched before it is hashed in watch mode")
+    parser.add_argument("--chunk-report", action="store_true",
+                        help="only report content shared between files at chunk level, do not remove anything")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_AVG_CHUNK,
+                        help="average chunk size in bytes for --chunk-report, a power of two")
+    parser.add_argument("--top", type=int, default=100,
+                        help="number of file pairs and groups written by --chunk-report")
+    parser.add_argument("--no-log-file", action="store_true", help="only log to stderr, not to removal_log.txt")
+    args = parser.parse_args(argv)
+    if not args.roots and not args.execute_plan:
+        parser.error("the following arguments are required: roots")
+    args.roots = unique_roots(args.roots)
+    if args.keep == "root" and not args.preferred_root:
+        parser.error("--keep root requires --preferred-root")
+    if args.chunk_size < 256 or args.chunk_size & (args.chunk_size - 1):
+        parser.error("--chunk-size must be a power of two of at least 256")
+    return args
+
+def unique_roots(roots):
+    """Return the roots as absolute paths, without repeats and without roots that lie inside another root."""
+    result = []
+    for root in sorted({os.path.abspath(root) for root in roots}):
+        if not any(root.startswith(os.path.join(outer, '')) for outer in result):
+            result.append(root)
+    return result
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process in bytes, or None where it is not available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def write_record(output, record):
+    """Write one JSON Lines record and flush it, so that readers see it right away."""
+    output.write(json.dumps(record) + "\n")
+    output.flush()
+
+def _stage_summary(scan_stats):
+    """Turn the cumulative stage timings of organize_files_by_checksum into per-stage figures."""
+    summary = {}
+    previous_end = 0.0
+    for stage, stage_stats in scan_stats.items():
+        seconds = max(stage_stats["seconds"] - previous_end, 0.0)
+        previous_end = max(stage_stats["seconds"], previous_end)
+        summary[stage] = {
+            "files": stage_stats["files"],
+            "bytes_read": stage_stats["bytes_read"],
+            "cached": stage_stats["cached"],
+            "seconds": round(seconds, 3),
+            "files_per_second": round(stage_stats["files"] / seconds, 1) if seconds else None,
+            "mb_per_second": round(stage_stats["bytes_read"] / seconds / (1024 * 1024), 1) if seconds else None,
+        }
+    return summary
+
+def run(args, output, logger):
+    """
+    Scan the roots, stream duplicate groups to output and remove the duplicates.
+
+    Returns:
+        dict: The summary record that was written last.
+    """
+    start_time = time.perf_counter()
+    scan_stats = {}
+    totals = {"groups": 0, "files": 0, "bytes": 0}
+
+    def on_group(checksum, size, paths):
+        totals["groups"] += 1
+        totals["files"] += len(paths)
+        totals["bytes"] += size * (len(paths) - 1)
+        write_record(output, {"type": "group", "checksum": checksum, "size": size, "files": paths})
+
+    walk_options = {"exclude_dirs": args.exclude, "min_size": args.min_size}
+    files = itertools.chain.from_iterable(scan_directory(root, **walk_options) for root in args.roots)
+    hardlinks = {}
+    scan_options = {"workers": args.workers, "use_processes": args.processes, "algorithm": args.algorithm,
+                    "on_group": on_group, "compact": args.compact, "hardlinks": hardlinks}
+
+    index_summary = None
+    if args.no_index:
+        checksum_dict = organize_files_by_checksum(files, scan_stats, **scan_options)
+    else:
+        with ChecksumIndex(args.index, args.algorithm) as index:
+            checksum_dict = organize_files_by_checksum(files, scan_stats, index=index, **scan_options)
+            pruned = index.prune(args.roots)
+        lookups = index.hits + index.misses
+        index_summary = {"hits": index.hits, "misses": index.misses, "pruned": pruned,
+                         "hit_rate": round(index.hits / lookups, 4) if lookups else None}
+    scan_seconds = time.perf_counter() - start_time
+
+    plan_start = time.perf_counter()
+    directory_groups = []
+    if args.compact and not args.no_directories:
+        # Tree hashes need a path -> digest dict of every duplicate, which --compact is meant to avoid
+        logger.info("Identical directory trees are not looked for with --compact")
+    elif not args.no_directories:
+        directory_groups = find_duplicate_directories(checksum_dict, args.roots)
+        for group in directory_groups:
+            write_record(output, {"type": "directory_group", "tree_hash": group.tree_hash, "size": group.size,
+                                  "file_count": group.file_count, "directories": group.directories})
+    plan = build_removal_plan(checksum_dict, args.keep, args.preferred_root, directory_groups, hardlinks)
+    if args.plan_file:
+        write_removal_plan(plan, args.plan_file)
+        logger.info(f"Removal plan written to {args.plan_file}")
+    plan_seconds = time.perf_counter() - plan_start
+
+    removal_start = time.perf_counter()
+    result = RemovalResult(0, 0)
+    if not args.dry_run:
+        result = execute_removal_plan(plan, args.mode, workers=args.removal_workers, journal_path=args.journal)
+    removal_seconds = time.perf_counter() - removal_start
+
+    total_seconds = time.perf_counter() - start_time
+    bytes_read = sum(stage_stats["bytes_read"] for stage_stats in scan_stats.values())
+    summary = {
+        "type": "summary",
+        "roots": args.roots,
+        "algorithm": args.algorithm,
+        "mode": args.mode,
+        "dry_run": args.dry_run,
+        "files_scanned": scan_stats["size"]["files"],
+        "hardlinks_skipped": scan_stats["size"]["hardlinks"],
+        "unreadable_files": scan_stats["partial"]["errors"] + scan_stats["full"]["errors"],
+        "duplicate_groups": totals["groups"],
+        "duplicate_files": totals["files"],
+        "reclaimable_bytes": totals["bytes"],
+        "duplicate_directory_groups": len(directory_groups),
+        "planned_removals": sum(len(group.remove) for group in plan),
+        "duplicates_removed": result.removed,
+        "removal_errors": result.errors,
+        "bytes_read": bytes_read,
+        "stages": _stage_summary(scan_stats),
+        "scan_seconds": round(scan_seconds, 3),
+        "plan_seconds": round(plan_seconds, 3),
+        "removal_seconds": round(removal_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "files_per_second": round(scan_stats["size"]["files"] / scan_seconds, 1) if scan_seconds else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "index": index_summary,
+    }
+    write_record(output, summary)
+    return summary
+
+def execute_plan(args, output, logger):
+    """
+    Carry out a saved removal plan without scanning again.
+
+    With --journal, running the same plan file again after an interruption
+    resumes where the last run stopped.
+
+    Returns:
+        dict: The summary record that was written.
+    """
+    start_time = time.perf_counter()
+    plan = read_removal_plan(args.execute_plan)
+    result = RemovalResult(0, 0)
+    if not args.dry_run:
+        result = execute_removal_plan(plan, args.mode, workers=args.removal_workers, journal_path=args.journal)
+    summary = {
+        "type": "summary",
+        "plan_file": args.execute_plan,
+        "mode": args.mode,
+        "dry_run": args.dry_run,
+        "planned_removals": sum(len(group.remove) for group in plan),
+        "duplicates_removed": result.removed,
+        "removal_errors": result.errors,
+        "removal_seconds": round(time.perf_counter() - start_time, 3),
+    }
+    write_record(output, summary)
+    return summary
+
+def watch(args, output, logger):
+    """Watch the roots and write a record for every new duplicate until interrupted; return the exit code."""
+    def on_duplicate(checksum, size, paths, removed):
+        write_record(output, {"type": "duplicate", "checksum": checksum, "size": size,
+                              "files": paths, "removed": removed})
+
+    deletion_mode = None if args.dry_run else args.mode
+    index = None if args.no_index else ChecksumIndex(args.index, args.algorithm)
+    try:
+        with DuplicateWatcher(args.roots, deletion_mode, args.keep, args.preferred_root, index=index,
+                              algorithm=args.algorithm, debounce=args.debounce, exclude_dirs=args.exclude,
+                              min_size=args.min_size, workers=args.workers, on_duplicate=on_duplicate) as watcher:
+            try:
+                watcher.start()
+            except OSError as e:
+                logger.error(f"Watch mode is not available: {e}")
+                return 2
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            logger.info(f"Stopped watching: {watcher.duplicates_found} new duplicates found, "
+                        f"{watcher.duplicates_removed} removed, {watcher.removal_errors} errors")
+            return 1 if watcher.removal_errors else 0
+    finally:
+        if index is not None:
+            index.close()
+
+def chunk_report(args, output, logger):
+    """Chunk every file under the roots and write the chunk-level sharing report; return the exit code."""
+    start_time = time.perf_counter()
+    walk_options = {"exclude_dirs": args.exclude, "min_size": args.min_size}
+    files = itertools.chain.from_iterable(scan_directory(root, **walk_options) for root in args.roots)
+    index = analyze_files(files, min_size=args.chunk_size // 4, avg_size=args.chunk_size,
+                          max_size=args.chunk_size * 8)
+
+    for path_a, path_b, shared_bytes in index.pairs()[:args.top]:
+        write_record(output, {"type": "chunk_pair", "files": [path_a, path_b], "shared_bytes": shared_bytes})
+    for paths, shared_bytes in index.groups()[:args.top]:
+        write_record(output, {"type": "chunk_group", "files": paths, "shared_bytes": shared_bytes})
+
+    seconds = time.perf_counter() - start_time
+    summary = {"type": "chunk_summary", "roots": args.roots, "chunk_size": args.chunk_size}
+    summary.update(index.summary())
+    summary.update({
+        "seconds": round(seconds, 3),
+        "mb_per_second": round(index.total_bytes / seconds / (1024 * 1024), 1) if seconds else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+    })
+    write_record(output, summary)
+    logger.info(f"Chunked {summary['files']} files: {summary['shared_bytes']} of {summary['total_bytes']} bytes "
+                f"are shared (dedup ratio {summary['dedup_ratio']})")
+    return 0
+
+def main(argv=None):
+    """Run DDAS from the command line and return the exit code."""
+    args = parse_args(argv)
+    logger = setup_logger(log_to_file=not args.no_log_file)
+    for root in args.roots:
+        if not os.path.isdir(root):
+            logger.error(f"Not a directory: {root}")
+            return 2
+
+    output = sys.stdout if args.output == "-" else open(args.output, 'w', encoding='utf-8')
+    try:
+        if args.execute_plan:
+            summary = execute_plan(args, output, logger)
+            logger.info(f"Removed {summary['duplicates_removed']} of {summary['planned_removals']} planned "
+                        f"duplicates from {args.execute_plan}")
+            return 1 if summary["removal_errors"] else 0
+        if args.watch:
+            return watch(args, output, logger)
+        if args.chunk_report:
+            return chunk_report(args, output, logger)
+        summary = run(args, output, logger)
+        logger.info(f"Scanned {summary['files_scanned']} files, found {summary['duplicate_groups']} duplicate groups, "
+                    f"removed {summary['duplicates_removed']} duplicates in {summary['total_seconds']} s")
+        return 1 if summary["removal_errors"] else 0
+    except (KeyboardInterrupt, ScanCancelled):
+        logger.info("Interrupted by user.")
+        return 130
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
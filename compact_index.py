@@ -0,0 +1,231 @@
+# Memory-efficient storage of scanned files and duplicate groups for very large trees.
+
+import os
+import bisect
+from array import array
+from collections.abc import Mapping, ItemsView
+from file_handler import FileEntry
+
+try:
+    import numpy  # Optional, makes sorting the digest column much faster
+except ImportError:
+    numpy = None
+
+class DirectoryTable:
+    """
+    Interned directory paths.
+
+    Every directory is stored once, as the id of its parent and its own name,
+    so the path prefix shared by the files of a tree is not repeated per file.
+    Directories are looked up by (parent id, name) as well, and the last
+    directory interned is remembered, because the files of one directory
+    arrive together from the walker.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self.parents = array('l')
+        self.names = []
+        self._last = (None, -1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, directory):
+        """Return the id of a directory path, adding it and its parents if needed."""
+        last_directory, last_id = self._last
+        if directory == last_directory:
+            return last_id
+        dir_id = self._intern(directory)
+        self._last = (directory, dir_id)
+        return dir_id
+
+    def _intern(self, directory):
+        parent, name = os.path.split(directory)
+        if not name or not parent or parent == directory:
+            # A root such as "/" or "C:\\", or the first part of a relative path
+            parent_id, name = -1, directory
+        else:
+            parent_id = self._intern(parent)
+        key = (parent_id, name)
+        dir_id = self._ids.get(key)
+        if dir_id is None:
+            dir_id = len(self.names)
+            self.parents.append(parent_id)
+            self.names.append(name)
+            self._ids[key] = dir_id
+        return dir_id
+
+    def path(self, dir_id):
+        """Return the path of a directory id."""
+        parts = []
+        while dir_id != -1:
+            parts.append(self.names[dir_id])
+            dir_id = self.parents[dir_id]
+        return os.path.join(*reversed(parts))
+
+class CompactFileTable:
+    """
+    Column store of FileEntry records.
+
+    Paths are split into an interned directory id and a basename. Basenames
+    live in one shared byte buffer and the stat fields in typed arrays, so a
+    file costs a few dozen bytes instead of several Python objects.
+    """
+
+    def __init__(self):
+        self.directories = DirectoryTable()
+        self.dir_ids = array('l')
+        self._names = bytearray()
+        self._name_offsets = array('Q', [0])
+        self.sizes = array('Q')
+        self.devs = array('Q')
+        self.inodes = array('Q')
+        self.mtimes = array('q')
+        self.nlinks = array('L')
+        self.ctimes = array('q')
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, entry):
+        """Store a FileEntry and return its file id."""
+        directory, name = os.path.split(entry.path)
+        self.dir_ids.append(self.directories.intern(directory) if directory else -1)
+        self._names += os.fsencode(name)
+        self._name_offsets.append(len(self._names))
+        self.sizes.append(entry.size)
+        self.devs.append(entry.dev)
+        self.inodes.append(entry.inode)
+        self.mtimes.append(entry.mtime_ns)
+        self.nlinks.append(entry.nlink)
+        self.ctimes.append(entry.ctime_ns)
+        return len(self.sizes) - 1
+
+    def path(self, file_id):
+        """Return the path of a file id."""
+        name = os.fsdecode(bytes(self._names[self._name_offsets[file_id]:self._name_offsets[file_id + 1]]))
+        dir_id = self.dir_ids[file_id]
+        return name if dir_id == -1 else os.path.join(self.directories.path(dir_id), name)
+
+    def entry(self, file_id):
+        """Return the FileEntry of a file id."""
+        return FileEntry(self.path(file_id), self.sizes[file_id], self.devs[file_id], self.inodes[file_id],
+                         self.mtimes[file_id], self.nlinks[file_id], self.ctimes[file_id])
+
+class CompactDuplicateIndex:
+    """
+    Digests of hashed files, stored as raw bytes in one column.
+
+    Duplicate groups are found by sorting the digest column, so no dictionary
+    from checksum to a list of paths is ever built.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.file_ids = array('Q')
+        self.digests = bytearray()
+        self.digest_size = None
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def add(self, file_id, checksum):
+        """Record the hex checksum of a file id."""
+        digest = bytes.fromhex(checksum)
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        elif len(digest) != self.digest_size:
+            raise ValueError("All checksums in an index must have the same length")
+        self.file_ids.append(file_id)
+        self.digests += digest
+
+    def digest(self, position):
+        """Return the raw digest stored at a position of the digest column."""
+        width = self.digest_size
+        return bytes(self.digests[position * width:(position + 1) * width])
+
+    def _sorted_runs(self):
+        """Return the positions ordered by digest and the (start, end) runs of equal digests."""
+        count = len(self.file_ids)
+        if count == 0:
+            return array('Q'), array('Q'), array('Q')
+        if numpy is not None:
+            column = numpy.frombuffer(bytes(self.digests), dtype=f"S{self.digest_size}")
+            order = numpy.argsort(column, kind='stable')
+            ordered = column[order]
+            boundaries = numpy.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+            starts = numpy.concatenate(([0], boundaries))
+            ends = numpy.concatenate((boundaries, [count]))
+            duplicate = (ends - starts) > 1
+            return (array('Q', order.astype(numpy.uint64).tobytes()),
+                    array('Q', starts[duplicate].astype(numpy.uint64).tobytes()),
+                    array('Q', ends[duplicate].astype(numpy.uint64).tobytes()))
+
+        order = array('Q', sorted(range(count), key=self.digest))
+        starts = array('Q')
+        ends = array('Q')
+        start = 0
+        for position in range(1, count + 1):
+            if position == count or self.digest(order[position]) != self.digest(order[start]):
+                if position - start > 1:
+                    starts.append(start)
+                    ends.append(position)
+                start = position
+        return order, starts, ends
+
+    def duplicate_groups(self):
+        """Return a lazy, read-only checksum -> [paths] mapping of the groups with more than one file."""
+        return DuplicateGroupsView(self)
+
+class _GroupItemsView(ItemsView):
+    """Items of a DuplicateGroupsView, produced run by run without looking checksums up again."""
+
+    def __iter__(self):
+        view = self._mapping
+        for run in range(len(view)):
+            yield view._checksum(run), view._paths(run)
+
+class DuplicateGroupsView(Mapping):
+    """
+    Read-only mapping from hex checksum to the list of paths sharing it.
+
+    It behaves like the dictionary organize_files_by_checksum() returns, but
+    the path lists are only built while a group is being looked at.
+    """
+
+    def __init__(self, index):
+        self._index = index
+        self._order, self._starts, self._ends = index._sorted_runs()
+        self._keys = None
+
+    def __len__(self):
+        return len(self._starts)
+
+    def _checksum(self, run):
+        return self._index.digest(self._order[self._starts[run]]).hex()
+
+    def _paths(self, run):
+        index = self._index
+        positions = sorted(self._order[self._starts[run]:self._ends[run]])
+        return [index.files.path(index.file_ids[position]) for position in positions]
+
+    def __iter__(self):
+        for run in range(len(self)):
+            yield self._checksum(run)
+
+    def __getitem__(self, checksum):
+        # Runs are sorted by digest, so the run can be found by binary search
+        if self._keys is None:
+            self._keys = [self._index.digest(self._order[start]) for start in self._starts]
+        try:
+            digest = bytes.fromhex(checksum)
+        except (TypeError, ValueError):
+            raise KeyError(checksum)
+        run = bisect.bisect_left(self._keys, digest)
+        if run == len(self._keys) or self._keys[run] != digest:
+            raise KeyError(checksum)
+        return self._paths(run)
+
+    def items(self):
+        return _GroupItemsView(self)
@@ -1,38 +1,636 @@
 # This script contains the function that removes duplicate files based on checksums.
 
 import os
+import sys
+import json
+import stat
+import time
+import hashlib
+import shutil
 import logging
+import itertools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
 from send2trash import send2trash  # Import send2trash for sending files to the trash
+from file_handler import home_trash_directory
+
+try:
+    import fcntl  # Needed for reflinks, only available on Unix
+except ImportError:
+    fcntl = None
 
 # Initialize logger
 logger = logging.getLogger('DuplicationRemover')
 
-def remove_duplicates(checksum_dict, deletion_mode="trash"):
+# ioctl request that clones a file's extents on Btrfs, XFS and other copy-on-write filesystems (Linux)
+FICLONE = 0x40049409
+
+# Ways to choose the file that is kept from a group of duplicates
+KEEP_POLICIES = ("first", "oldest", "shortest", "root")
+
+# Number of duplicates handled by one worker task, and the default number of workers
+DEFAULT_BATCH_SIZE = 512
+DEFAULT_REMOVAL_WORKERS = 8
+
+# One group of a removal plan: the file (or directory) that is kept, the duplicates that are removed
+# and the state of each of them when the plan was made ({path: snapshot}, see _file_snapshot())
+RemovalGroup = namedtuple('RemovalGroup', ['checksum', 'size', 'keep', 'remove', 'kind', 'snapshots'],
+                          defaults=("file", None))
+
+# Outcome of execute_removal_plan(): duplicates removed and duplicates that could not be removed
+RemovalResult = namedtuple('RemovalResult', ['removed', 'errors'])
+
+# Trash directories by device, filled on first use (None means fall back to send2trash)
+_trash_directories = {}
+_trash_lock = threading.Lock()
+_trash_counter = itertools.count(1)
+
+def is_same_file(file_a, file_b):
+    """Return True if both paths are names of the same inode (hard links), False otherwise."""
+    try:
+        return os.path.samefile(file_a, file_b)
+    except OSError:
+        return False
+
+def _reflink(source, target):
+    """Create target as a copy-on-write clone of source using the FICLONE ioctl."""
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def replace_with_link(kept_file, duplicate):
     """
-    Remove duplicates by either sending files to trash or deleting permanently.
-    
+    Replace a duplicate file with a link to the file that is kept.
+
+    A reflink (a copy-on-write clone sharing the kept file's data blocks) is
+    used where the filesystem supports FICLONE. Otherwise the duplicate is
+    replaced with a hard link. The link is created under a temporary name and
+    renamed over the duplicate, so the duplicate's path never disappears.
+
     Parameters:
-        checksum_dict (dict): Dictionary of checksums with lists of file paths.
-        deletion_mode (str): Either 'trash' or 'permanent' for deletion mode.
+        kept_file (str): The file that is kept.
+        duplicate (str): The duplicate to replace. Must be on the same filesystem.
+
+    Returns:
+        str: "reflink" or "hardlink", depending on the link that was created.
     """
-    duplicates_removed = 0
+    directory, name = os.path.split(duplicate)
+    temp_path = os.path.join(directory, f".{name}.ddas-{os.getpid()}")
+    try:
+        try:
+            _reflink(kept_file, temp_path)
+            # A reflink is a new inode, so give it the duplicate's permissions and times
+            shutil.copystat(duplicate, temp_path)
+            link_type = "reflink"
+        except OSError:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            os.link(kept_file, temp_path)
+            link_type = "hardlink"
+        os.replace(temp_path, duplicate)
+    except Exception:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return link_type
+
+def replace_directory_with_link(kept_dir, duplicate):
+    """
+    Replace a duplicate directory tree with a symbolic link to the directory that is kept.
+
+    Directories cannot be hard-linked, so the whole subtree becomes one
+    symlink. The duplicate is first renamed aside and only deleted once the
+    link is in its place; if the link cannot be put in place the duplicate is
+    renamed back.
+
+    Returns:
+        str: "symlink".
+    """
+    parent, name = os.path.split(os.path.normpath(duplicate))
+    temp_link = os.path.join(parent, f".{name}.ddas-link-{os.getpid()}")
+    temp_dir = os.path.join(parent, f".{name}.ddas-old-{os.getpid()}")
+    os.symlink(os.path.abspath(kept_dir), temp_link, target_is_directory=True)
+    try:
+        os.rename(duplicate, temp_dir)
+        try:
+            os.rename(temp_link, duplicate)
+        except OSError:
+            os.rename(temp_dir, duplicate)
+            raise
+    except Exception:
+        os.remove(temp_link)
+        raise
+    shutil.rmtree(temp_dir)
+    return "symlink"
+
+def _uses_freedesktop_trash():
+    """Return True on systems that use the freedesktop.org trash layout (Linux and other Unix desktops)."""
+    return os.name == 'posix' and sys.platform != 'darwin'
+
+def _find_mount_point(path):
+    """Return the top directory of the filesystem that contains path."""
+    path = os.path.realpath(path)
+    device = os.stat(path).st_dev
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path or os.stat(parent).st_dev != device:
+            return path
+        path = parent
+
+def _make_trash_directory(trash_dir):
+    """Create the files/ and info/ subdirectories of a trash directory."""
+    for subdir in ("files", "info"):
+        os.makedirs(os.path.join(trash_dir, subdir), mode=0o700, exist_ok=True)
+
+def get_trash_directory(file_path):
+    """
+    Return the trash directory on the same device as a file.
+
+    The home trash is used for files on the home device; other devices get a
+    .Trash-<uid> directory at the top of their filesystem, so trashing a file
+    is always a rename and never a copy. Results are cached per device.
+
+    Returns:
+        tuple: (trash_dir, top_dir), where top_dir is None for the home trash,
+        or None if no trash directory can be used on that device.
+    """
+    device = os.lstat(file_path).st_dev
+    with _trash_lock:
+        if device in _trash_directories:
+            return _trash_directories[device]
+        try:
+            home_trash = home_trash_directory()
+            _make_trash_directory(home_trash)
+            if os.stat(home_trash).st_dev == device:
+                result = (home_trash, None)
+            else:
+                top_dir = _find_mount_point(os.path.dirname(os.path.abspath(file_path)))
+                trash_dir = os.path.join(top_dir, f".Trash-{os.getuid()}")
+                _make_trash_directory(trash_dir)
+                result = (trash_dir, top_dir)
+        except OSError as e:
+            logger.error(f"No trash directory available for device {device}: {e}")
+            result = None
+        _trash_directories[device] = result
+        return result
+
+def move_to_trash(file_path):
+    """
+    Move a file to the trash on its own filesystem and write its .trashinfo record.
+
+    On systems without a freedesktop.org trash (Windows, macOS), or when no trash
+    directory can be created on the file's device, send2trash is used instead.
+    """
+    trash = get_trash_directory(file_path) if _uses_freedesktop_trash() else None
+    if trash is None:
+        send2trash(file_path)
+        return
+
+    trash_dir, top_dir = trash
+    abs_path = os.path.abspath(file_path)
+    name = os.path.basename(abs_path)
+    base, extension = os.path.splitext(name)
+
+    # Reserve a unique name by creating the info file exclusively
+    trash_name = name
+    while True:
+        info_path = os.path.join(trash_dir, "info", f"{trash_name}.trashinfo")
+        try:
+            fd = os.open(info_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            break
+        except FileExistsError:
+            trash_name = f"{base}.{os.getpid()}-{next(_trash_counter)}{extension}"
+
+    original_path = os.path.relpath(abs_path, top_dir) if top_dir else abs_path
+    with os.fdopen(fd, 'w') as info_file:
+        info_file.write("[Trash Info]\n")
+        info_file.write(f"Path={quote(original_path)}\n")
+        info_file.write(f"DeletionDate={time.strftime('%Y-%m-%dT%H:%M:%S')}\n")
+    try:
+        os.rename(abs_path, os.path.join(trash_dir, "files", trash_name))
+    except OSError:
+        os.remove(info_path)
+        raise
+
+def _choose_kept_file(file_group, keep, preferred_root):
+    """Return the file of a group that is kept, according to the keep policy."""
+    if keep == "first":
+        return file_group[0]
+    if keep == "shortest":
+        return min(file_group, key=lambda file: (len(file), file))
+    if keep == "oldest":
+        mtimes = {}
+        for file in file_group:
+            try:
+                mtimes[file] = os.stat(file).st_mtime_ns
+            except OSError:
+                continue
+        return min(mtimes, key=mtimes.get) if mtimes else file_group[0]
+    if keep == "root":
+        root = os.path.join(os.path.abspath(preferred_root), '')
+        for file in file_group:
+            if os.path.abspath(file).startswith(root):
+                return file
+        return file_group[0]
+    raise ValueError(f"Unknown keep policy: {keep}")
+
+def _file_snapshot(file_stat):
+    """Return the stat fields that show whether a file was replaced or modified, as a JSON-friendly list."""
+    return [file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns]
+
+def _tree_manifest(directory):
+    """Return a digest of the relative path, type, size, mtime and ctime of everything in a directory tree."""
+    digest = hashlib.sha256()
+
+    def fail(error):
+        raise error
+
+    for dirpath, dirnames, filenames in os.walk(directory, onerror=fail):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            entry_stat = os.lstat(path)
+            digest.update(os.fsencode(os.path.relpath(path, directory)) + b"\0")
+            if stat.S_ISDIR(entry_stat.st_mode):
+                digest.update(b"d\n")
+            else:
+                digest.update(f"{stat.S_IFMT(entry_stat.st_mode)} {entry_stat.st_size} "
+                              f"{entry_stat.st_mtime_ns} {entry_stat.st_ctime_ns}\n".encode())
+    return digest.hexdigest()
+
+def _directory_snapshot(directory):
+    """Return the device, inode and tree manifest of a directory, as a JSON-friendly list."""
+    directory_stat = os.lstat(directory)
+    return [directory_stat.st_dev, directory_stat.st_ino, _tree_manifest(directory)]
+
+def _ancestors(path):
+    """Yield the directories that contain path, innermost first."""
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        yield parent
+        path, parent = parent, os.path.dirname(parent)
+
+def _is_below(path, directories):
+    """Return True if path lies inside one of the directories (a set of paths)."""
+    return any(parent in directories for parent in _ancestors(path))
+
+def _build_directory_plan(directory_groups, keep, preferred_root):
+    """
+    Plan the removal of whole duplicate subtrees and return (plan, removed directories, kept directories).
+
+    Groups are planned largest first, and of equally large groups the one
+    with the shallowest directories first, so an outer directory is usually
+    planned before the copies it contains. Whatever the order, a directory
+    that is, contains or lies inside a kept directory is never removed, and a
+    directory that contains a removed one is never kept, because it is no
+    longer a complete copy.
+    """
+    plan = []
+    removed = set()
+    kept = set()
+    contains_kept = set()
+    contains_removed = set()
+    ordered = sorted(directory_groups, key=lambda group: (
+        -group.size, min(directory.count(os.sep) for directory in group.directories), group.directories))
+    for group in ordered:
+        # A copy inside a subtree that is already being removed goes with it
+        directories = [directory for directory in group.directories
+                       if directory not in removed and not _is_below(directory, removed)]
+        keepable = [directory for directory in directories if directory not in contains_removed]
+        if len(directories) < 2 or not keepable:
+            continue
+        protected = {directory for directory in directories
+                     if directory in contains_kept or _is_below(directory, kept)}
+        kept_dir = _choose_kept_file([directory for directory in keepable if directory in protected] or keepable,
+                                     keep, preferred_root)
+        kept.add(kept_dir)
+        contains_kept.update(_ancestors(kept_dir))
+        duplicates = [directory for directory in directories
+                      if directory != kept_dir and directory not in protected and not is_same_file(directory, kept_dir)]
+        if duplicates:
+            try:
+                snapshots = {directory: _directory_snapshot(directory) for directory in [kept_dir] + duplicates}
+            except OSError as e:
+                logger.error(f"Skipping directory group {group.tree_hash}, a copy is not accessible: {e}")
+                continue
+            covering = {directory for directory in duplicates if directory in contains_removed}
+            if covering:
+                # Copies planned earlier inside these directories go with them
+                plan = [planned._replace(remove=[directory for directory in planned.remove
+                                                 if not _is_below(directory, covering)]) for planned in plan]
+                plan = [planned for planned in plan if planned.remove]
+                removed = {directory for directory in removed if not _is_below(directory, covering)}
+            plan.append(RemovalGroup(group.tree_hash, group.size, kept_dir, duplicates, "directory", snapshots))
+            removed.update(duplicates)
+            for directory in duplicates:
+                contains_removed.update(_ancestors(directory))
+    return plan, removed, kept
+
+def build_removal_plan(checksum_dict, keep="first", preferred_root=None, directory_groups=(), hardlinks=None):
+    """
+    Decide which file of every duplicate group is kept and which ones are removed.
+
+    When directory_groups are given, each group of identical subtrees becomes
+    one plan entry that removes the duplicate directories as a whole. Files
+    inside those directories are left out of the per-file groups, and files
+    inside a kept directory are always kept.
+
+    Parameters:
+        checksum_dict (dict): Dictionary of checksums with lists of file paths, or a
+            DuplicateGroupsView.
+        keep (str): 'first' keeps the first file of each group, 'oldest' the one
+            with the oldest modification time, 'shortest' the one with the
+            shortest path, and 'root' the first one below preferred_root.
+        preferred_root (str, optional): Directory whose files are kept with 'root'.
+        directory_groups (list, optional): DirectoryGroup records from
+            tree_hash.find_duplicate_directories().
+        hardlinks (dict, optional): Other names of hard-linked files, as
+            filled in by organize_files_by_checksum(). Every other name of a
+            duplicate is removed along with it; otherwise those names would
+            keep the duplicate's data on disk.
+
+    Returns:
+        list: RemovalGroup records, directory groups first. Files that no
+        longer exist and hard links of the kept file are left out. Each group
+        holds a snapshot of every path in it, so that execute_removal_plan()
+        can tell whether a path changed after the plan was made.
+    """
+    if keep == "root" and not preferred_root:
+        raise ValueError("The 'root' keep policy needs a preferred_root")
+
+    plan, removed_dirs, kept_dirs = _build_directory_plan(directory_groups, keep, preferred_root)
     for checksum, file_group in checksum_dict.items():
-        if len(file_group) > 1:
-            # Keep the first file, remove the rest as duplicates
-            for file in file_group[1:]:
+        if removed_dirs:
+            file_group = [file for file in file_group if not _is_below(file, removed_dirs)]
+        if len(file_group) < 2:
+            continue
+        # Files inside a kept directory stay, or the removed copies of that directory would be lost
+        protected = [file for file in file_group if _is_below(file, kept_dirs)] if kept_dirs else []
+        kept_file = _choose_kept_file(protected or file_group, keep, preferred_root)
+        try:
+            kept_stat = os.stat(kept_file)
+        except OSError as e:
+            logger.error(f"Skipping group {checksum}, kept file is not accessible: {e}")
+            continue
+
+        duplicates = []
+        snapshots = {kept_file: _file_snapshot(kept_stat)}
+        for file in file_group:
+            if file == kept_file or file in protected:
+                continue
+            try:
+                file_stat = os.stat(file)
+            except OSError:
+                continue
+            if (file_stat.st_dev, file_stat.st_ino) == (kept_stat.st_dev, kept_stat.st_ino):
+                continue
+            duplicates.append(file)
+            snapshots[file] = _file_snapshot(file_stat)
+            for other_name in hardlinks.get(file, ()) if hardlinks else ():
                 try:
-                    if deletion_mode == "trash":
-                        send2trash(file)  # Send the duplicate file to the trash
-                        logger.info(f"Sent to trash: {file}")
-                    elif deletion_mode == "permanent":
-                        os.remove(file)  # Permanently delete the file
-                        logger.info(f"Permanently deleted: {file}")
-                    
-                    duplicates_removed += 1
-                except Exception as e:
-                    logger.error(f"Error removing file {file}: {e}")
-    
+                    snapshots[other_name] = _file_snapshot(os.stat(other_name))
+                except OSError:
+                    continue
+                duplicates.append(other_name)
+        if duplicates:
+            plan.append(RemovalGroup(checksum, kept_stat.st_size, kept_file, duplicates, "file", snapshots))
+    return plan
+
+def write_removal_plan(plan, plan_path):
+    """Write a removal plan as JSON Lines (one group per line), e.g. for a dry run."""
+    with open(plan_path, 'w', encoding='utf-8') as plan_file:
+        for group in plan:
+            plan_file.write(json.dumps(group._asdict()) + "\n")
+
+def read_removal_plan(plan_path):
+    """Read a removal plan written by write_removal_plan()."""
+    with open(plan_path, 'r', encoding='utf-8') as plan_file:
+        return [RemovalGroup(**json.loads(line)) for line in plan_file if line.strip()]
+
+def removal_plan_id(plan):
+    """Return an id of the contents of a removal plan; the same plan read back from a file has the same id."""
+    digest = hashlib.sha256()
+    for group in plan:
+        digest.update(json.dumps(group._asdict()).encode('utf-8') + b"\n")
+    return digest.hexdigest()[:16]
+
+def _read_journal(journal_path, plan_id):
+    """
+    Return the set of duplicates already handled according to a removal journal,
+    or None if there is no journal of this plan.
+
+    The first line of a journal names the plan it belongs to. A journal of
+    any other plan is ignored, so an old journal never causes files to be
+    skipped.
+    """
+    done = set()
+    if not journal_path or not os.path.exists(journal_path):
+        return None
+    with open(journal_path, 'r', encoding='utf-8') as journal:
+        try:
+            header = json.loads(journal.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("plan_id") != plan_id:
+            return None
+        for line in journal:
+            try:
+                done.add(json.loads(line)["path"])
+            except (ValueError, KeyError):
+                continue  # A line cut short by an interruption
+    return done
+
+def _open_journal(journal_path, plan_id, resume):
+    """Open a journal for appending, or start a new one for plan_id if it is not resumed."""
+    if resume:
+        return open(journal_path, 'a', encoding='utf-8')
+    journal = open(journal_path, 'w', encoding='utf-8')
+    journal.write(json.dumps({"plan_id": plan_id}) + "\n")
+    journal.flush()
+    return journal
+
+def _matches_snapshot(file_stat, snapshot, touched):
+    """Return True if a file is in the state recorded by the removal plan."""
+    current = _file_snapshot(file_stat)
+    if current == snapshot:
+        return True
+    # Removing or linking a name of an inode updates its ctime, so inodes this run has touched may differ in ctime only
+    return current[:4] == snapshot[:4] and touched is not None and (current[0], current[1]) in touched
+
+def _remove_duplicate(kept_file, duplicate, deletion_mode, kind="file", snapshots=None, touched=None):
+    """
+    Remove one duplicate file or directory and return what was done.
+
+    Both the kept path and the duplicate must still match their snapshots in
+    the plan; otherwise RuntimeError is raised and nothing is removed. The
+    inodes of the files this removes or links to are added to touched.
+
+    Returns:
+        str: 'trash', 'permanent', 'reflink', 'hardlink' or 'symlink' when the
+        duplicate was removed, 'missing' if it was already gone, or 'same-file'
+        if it is a hard link of the kept file.
+    """
+    try:
+        duplicate_stat = os.lstat(duplicate)
+    except FileNotFoundError:
+        return "missing"
+    kept_stat = os.stat(kept_file)  # Never remove a duplicate when the kept copy is gone
+    if (duplicate_stat.st_dev, duplicate_stat.st_ino) == (kept_stat.st_dev, kept_stat.st_ino):
+        return "same-file"
+    if not snapshots or kept_file not in snapshots or duplicate not in snapshots:
+        raise RuntimeError("the removal plan has no snapshot of this path, make the plan again")
+    if kind == "directory":
+        if not stat.S_ISDIR(kept_stat.st_mode) or not stat.S_ISDIR(duplicate_stat.st_mode):
+            raise RuntimeError("not a directory any more")
+        if (_directory_snapshot(kept_file) != snapshots[kept_file]
+                or _directory_snapshot(duplicate) != snapshots[duplicate]):
+            raise RuntimeError("directory contents changed since the removal plan was made")
+    else:
+        if (not _matches_snapshot(kept_stat, snapshots[kept_file], touched)
+                or not _matches_snapshot(duplicate_stat, snapshots[duplicate], touched)):
+            raise RuntimeError("file changed since the removal plan was made")
+        if touched is not None:
+            touched.add((duplicate_stat.st_dev, duplicate_stat.st_ino))
+            if deletion_mode == "link":
+                touched.add((kept_stat.st_dev, kept_stat.st_ino))
+
+    if deletion_mode == "trash":
+        move_to_trash(duplicate)
+        return "trash"
+    if deletion_mode == "permanent":
+        if kind == "directory":
+            shutil.rmtree(duplicate)
+        else:
+            os.remove(duplicate)
+        return "permanent"
+    if deletion_mode == "link":
+        if kind == "directory":
+            return replace_directory_with_link(kept_file, duplicate)
+        return replace_with_link(kept_file, duplicate)
+    raise ValueError(f"Unknown deletion mode: {deletion_mode}")
+
+def _remove_batch(batch, deletion_mode, cancel=None, touched=None):
+    """Remove a batch of (kept_file, duplicate, kind, snapshots) tasks and return (duplicate, status, error) results."""
+    results = []
+    for kept_file, duplicate, kind, snapshots in batch:
+        if cancel is not None and cancel.is_set():
+            break
+        try:
+            results.append((duplicate, _remove_duplicate(kept_file, duplicate, deletion_mode, kind,
+                                                         snapshots, touched), None))
+        except Exception as e:
+            results.append((duplicate, None, e))
+    return results
+
+_STATUS_MESSAGES = {
+    "trash": "Sent to trash",
+    "permanent": "Permanently deleted",
+    "reflink": "Replaced with reflink",
+    "hardlink": "Replaced with hardlink",
+    "symlink": "Replaced directory with symlink",
+    "missing": "Already removed",
+    "same-file": "Skipped hard link of kept file",
+}
+
+def execute_removal_plan(plan, deletion_mode="trash", workers=DEFAULT_REMOVAL_WORKERS,
+                         batch_size=DEFAULT_BATCH_SIZE, journal_path=None, progress=None, cancel=None):
+    """
+    Carry out a removal plan in batches on a pool of worker threads.
+
+    Every duplicate is checked against the kept file first: it is skipped if
+    the kept file is gone or if both are the same inode, and it is left alone
+    (and counted as an error) if the duplicate or the kept file no longer
+    matches its snapshot in the plan: another inode, size, mtime or ctime, or
+    for a directory any change to the paths, sizes and times in its tree.
+    All duplicate directories are handled before the first file batch starts.
+
+    Parameters:
+        plan (list): RemovalGroup records from build_removal_plan().
+        deletion_mode (str): 'trash', 'permanent' or 'link'.
+        workers (int): Number of worker threads.
+        batch_size (int): Number of duplicates handled by one worker task.
+        journal_path (str, optional): File that records every handled duplicate.
+            Running the same plan again with the same journal skips them, so an
+            interrupted run can be resumed. The journal starts with the id of
+            its plan and is ignored for any other plan; it is emptied once
+            the whole plan has been carried out.
+        progress (callable, optional): Called as progress(processed, total)
+            after each batch.
+        cancel (threading.Event, optional): When set, no further duplicates
+            are removed and the function returns early.
+
+    Returns:
+        RemovalResult: The number of duplicates removed and the number that
+        failed with an error (which are logged).
+    """
+    plan_id = removal_plan_id(plan)
+    done = _read_journal(journal_path, plan_id)
+    if done:
+        logger.info(f"Resuming removal plan {plan_id}: {len(done)} duplicates already handled")
+    tasks = [(group.keep, duplicate, group.kind, group.snapshots) for group in plan for duplicate in group.remove
+             if not done or duplicate not in done]
+    # Directories are removed before any file, so no file task runs while their trees are compared
+    phases = ([task for task in tasks if task[2] == "directory"], [task for task in tasks if task[2] != "directory"])
+    touched = set()  # (dev, inode) of the files whose ctime this run changes itself
+
+    duplicates_removed = 0
+    errors = 0
+    processed = 0
+    journal = _open_journal(journal_path, plan_id, resume=done is not None) if journal_path else None
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ddas-remove")
+    try:
+        for phase in phases:
+            futures = [executor.submit(_remove_batch, phase[start:start + batch_size], deletion_mode, cancel, touched)
+                       for start in range(0, len(phase), batch_size)]
+            for future in as_completed(futures):
+                for duplicate, status, error in future.result():
+                    processed += 1
+                    if error is not None:
+                        logger.error(f"Error removing file {duplicate}: {error}")
+                        errors += 1
+                        continue
+                    logger.info(f"{_STATUS_MESSAGES[status]}: {duplicate}")
+                    if status not in ("missing", "same-file"):
+                        duplicates_removed += 1
+                    if journal is not None:
+                        journal.write(json.dumps({"path": duplicate, "status": status}) + "\n")
+                if journal is not None:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                if progress is not None:
+                    progress(processed, len(tasks))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if journal is not None:
+            # Only a plan that was carried out to the end is forgotten; otherwise it can be resumed
+            if processed == len(tasks):
+                journal.truncate(0)
+            journal.close()
+
+    # Batches still waiting when cancel was set return without touching any file
+    if cancel is not None and cancel.is_set():
+        logger.info(f"Removal cancelled after {processed} of {len(tasks)} duplicates")
+
     logger.info(f"Total duplicates removed: {duplicates_removed}")
-    return duplicates_removed
+    if errors:
+        logger.error(f"{errors} duplicates could not be removed")
+    return RemovalResult(duplicates_removed, errors)
 
+def remove_duplicates(checksum_dict, deletion_mode="trash", keep="first", preferred_root=None,
+                      workers=DEFAULT_REMOVAL_WORKERS):
+    """
+    Remove duplicates by sending files to trash, deleting them permanently or replacing them with links.
 
+    Parameters:
+        checksum_dict (dict): Dictionary of checksums with lists of file paths, or a
+            DuplicateGroupsView.
+        deletion_mode (str): 'trash', 'permanent' or 'link' for deletion mode.
+        keep (str): Keep policy, see build_removal_plan().
+        preferred_root (str, optional): Directory whose files are kept with the 'root' policy.
+        workers (int): Number of worker threads.
+    """
+    plan = build_removal_plan(checksum_dict, keep, preferred_root)
+    return execute_removal_plan(plan, deletion_mode, workers=workers).removed
@@ -2,31 +2,581 @@
 
 
 import os
+import mmap
+import time
+import queue
 import hashlib
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from collections import namedtuple
+
+# Number of bytes hashed from the start and from the end of a file in the partial hash stage
+PARTIAL_HASH_SIZE = 4096
+
+# Size of each read when hashing a whole file
+DEFAULT_READ_SIZE = 1024 * 1024
+
+# Files at least this large are hashed through mmap instead of read() calls
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Default number of hashing workers (same default as ThreadPoolExecutor)
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Maximum number of FileEntry records buffered between the directory walker and the hashing stage
+DEFAULT_QUEUE_SIZE = 16384
+
+# Number of FileEntry records passed through the scan queue at a time
+SCAN_BATCH_SIZE = 256
+
+# Number of checksum records written to a ChecksumIndex at a time
+INDEX_BATCH_SIZE = 8192
+
+logger = logging.getLogger('DuplicationRemover')
+
+class ScanCancelled(Exception):
+    """Raised by organize_files_by_checksum() and generate_checksum() when the scan is cancelled."""
+
+# A file path together with the stat data used to group and cache it
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'dev', 'inode', 'mtime_ns', 'nlink', 'ctime_ns'])
+
+def home_trash_directory():
+    """Return the path of the user's freedesktop.org home trash."""
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.path.join(data_home, 'Trash')
+
+def is_trash_directory(path):
+    """Return True if path is a trash directory: the home trash, or a .Trash or .Trash-<uid> directory."""
+    name = os.path.basename(path)
+    if name == ".Trash" or name.startswith(".Trash-"):
+        return True
+    return name == "Trash" and os.path.abspath(path) == os.path.abspath(home_trash_directory())
+
+def walk_files(directory, exclude_dirs=(), min_size=0, one_filesystem=True, on_directory=None, exclude_trash=True):
+    """
+    Yield a FileEntry for every regular file in a directory and its subdirectories.
+
+    The tree is walked with os.scandir and the stat data comes from each
+    DirEntry, so no file is stat'ed twice. Symbolic links are never followed
+    or yielded, and directories that cannot be read are skipped.
+
+    Parameters:
+        directory (str): The directory to walk.
+        exclude_dirs (iterable): Directory names (such as ".git") or paths
+            whose subtrees are skipped.
+        min_size (int): Files smaller than this many bytes are skipped.
+        one_filesystem (bool): Skip directories on another device, such as
+            mount points below the directory.
+        on_directory (callable, optional): Called with the path of every
+            directory that is walked, starting with directory itself.
+        exclude_trash (bool): Skip trash directories below directory, so
+            files that were trashed by an earlier run are never compared
+            with the live copies.
+    """
+    exclude_names = set()
+    exclude_paths = set()
+    for excluded in exclude_dirs:
+        if os.sep in excluded or (os.altsep and os.altsep in excluded):
+            exclude_paths.add(os.path.abspath(excluded))
+        else:
+            exclude_names.add(excluded)
+
+    # DirEntry.stat() reports st_dev as 0 on Windows, so fall back to the root's device
+    root_dev = os.stat(directory).st_dev
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            scanner = os.scandir(current)
+        except OSError:
+            continue
+        if on_directory is not None:
+            on_directory(current)
+        with scanner:
+            for dir_entry in scanner:
+                try:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        if dir_entry.name in exclude_names:
+                            continue
+                        if exclude_paths and os.path.abspath(dir_entry.path) in exclude_paths:
+                            continue
+                        if exclude_trash and is_trash_directory(dir_entry.path):
+                            continue
+                        if one_filesystem and (dir_entry.stat(follow_symlinks=False).st_dev or root_dev) != root_dev:
+                            continue
+                        pending.append(dir_entry.path)
+                    elif dir_entry.is_file(follow_symlinks=False):
+                        st = dir_entry.stat(follow_symlinks=False)
+                        if st.st_size >= min_size:
+                            yield FileEntry(dir_entry.path, st.st_size, st.st_dev or root_dev,
+                                            dir_entry.inode(), st.st_mtime_ns, st.st_nlink, st.st_ctime_ns)
+                except OSError:
+                    continue
+
+def scan_directory(directory, queue_size=DEFAULT_QUEUE_SIZE, **walk_options):
+    """
+    Walk a directory in a background thread and yield its FileEntry records.
+
+    The walker and the consumer are connected by a bounded queue, so the walk
+    keeps going while the consumer hashes, and at most queue_size records are
+    buffered in between. walk_options are passed on to walk_files().
+    """
+    batches = queue.Queue(maxsize=max(1, queue_size // SCAN_BATCH_SIZE))
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Give up if the consumer went away, so the walker thread can exit
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def walk():
+        batch = []
+        try:
+            for entry in walk_files(directory, **walk_options):
+                batch.append(entry)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(finished)
+        except Exception as e:
+            put(e)
+
+    walker = threading.Thread(target=walk, name="ddas-walker", daemon=True)
+    walker.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+    finally:
+        stopped.set()
+        walker.join()
 
 def get_files_in_directory(directory):
     """Get all files in a given directory and its subdirectories."""
-    files = []
-    for root, _, filenames in os.walk(directory):
-        for filename in filenames:
-            file_path = os.path.join(root, filename)
-            files.append(file_path)
-    return files
-
-def generate_checksum(file_path):
-    """Generate MD5 checksum for a given file."""
-    hash_md5 = hashlib.md5()
+    return [entry.path for entry in walk_files(directory)]
+
+def generate_checksum(file_path, read_size=DEFAULT_READ_SIZE, mmap_threshold=MMAP_THRESHOLD, algorithm="md5",
+                      cancel=None):
+    """
+    Generate a checksum (MD5 by default) for a given file.
+
+    The file is read into a reusable buffer of read_size bytes. Files of at
+    least mmap_threshold bytes are mapped into memory instead, which avoids
+    copying their contents into Python. Pass mmap_threshold=None to disable mmap.
+    algorithm is any name accepted by hashlib.new(). If the cancel event is
+    set, ScanCancelled is raised before the next block is hashed.
+    """
+    hash_md5 = hashlib.new(algorithm)
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+        file_size = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and file_size > 0 and file_size >= mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), read_size):
+                        if cancel is not None and cancel.is_set():
+                            raise ScanCancelled()
+                        hash_md5.update(view[offset:offset + read_size])
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(read_size)
+            view = memoryview(buffer)
+            for bytes_read in iter(lambda: f.readinto(buffer), 0):
+                if cancel is not None and cancel.is_set():
+                    raise ScanCancelled()
+                hash_md5.update(view[:bytes_read])
     return hash_md5.hexdigest()
 
-def organize_files_by_checksum(files):
-    """Organize files by checksum (grouping duplicates)."""
-    checksum_dict = {}
-    for file in files:
-        checksum = generate_checksum(file)
-        if checksum not in checksum_dict:
-            checksum_dict[checksum] = []
-        checksum_dict[checksum].append(file)
+def generate_partial_checksum(file_path, file_size, block_size=PARTIAL_HASH_SIZE, algorithm="md5"):
+    """
+    Generate a checksum (MD5 by default) of the first and last block of a file.
+
+    Files no larger than two blocks are hashed whole, so for them the
+    result is identical to generate_checksum() with the same algorithm.
+    """
+    hash_md5 = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        if file_size <= 2 * block_size:
+            hash_md5.update(f.read())
+        else:
+            hash_md5.update(f.read(block_size))
+            f.seek(-block_size, os.SEEK_END)
+            hash_md5.update(f.read(block_size))
+    return hash_md5.hexdigest()
+
+def _call_with_limit(limit, func, *args):
+    """Call func while holding the given semaphore."""
+    with limit:
+        return func(*args)
+
+def _run_now(func, *args):
+    """Run func in the calling thread and return its outcome as a Future."""
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+@contextmanager
+def _hash_pool(workers=DEFAULT_WORKERS, io_concurrency=None, use_processes=False):
+    """Yield a submit(func, *args) function that returns a Future, backed by a worker pool."""
+    if workers <= 1:
+        yield _run_now
+        return
+
+    if use_processes:
+        # Processes cannot share a semaphore cheaply, so cap the pool size instead
+        if io_concurrency is not None:
+            workers = max(1, min(workers, io_concurrency))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        submit = executor.submit
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ddas-hash")
+        submit = executor.submit
+        if io_concurrency is not None and io_concurrency < workers:
+            submit = partial(executor.submit, _call_with_limit, threading.BoundedSemaphore(io_concurrency))
+    try:
+        yield submit
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def hash_files(hash_func, *arg_lists, workers=DEFAULT_WORKERS, io_concurrency=None, use_processes=False):
+    """
+    Run hash_func over several files concurrently.
+
+    hash_func is called as hash_func(arg_lists[0][i], arg_lists[1][i], ...) for
+    every i, the same way as the built-in map(). hashlib releases the GIL while
+    hashing large buffers, so a thread pool scales with the number of cores.
+
+    Parameters:
+        hash_func (callable): Function that returns the checksum of one file.
+        arg_lists (list): Argument lists, usually the file paths first.
+        workers (int): Number of worker threads or processes. 1 hashes serially.
+        io_concurrency (int, optional): Maximum number of files read at the
+            same time. Defaults to the number of workers.
+        use_processes (bool): Use a process pool instead of a thread pool.
+
+    Returns:
+        list: The checksums, in the same order as the arguments.
+    """
+    with _hash_pool(workers, io_concurrency, use_processes) as submit:
+        futures = [submit(hash_func, *args) for args in zip(*arg_lists)]
+        return [future.result() for future in futures]
+
+def stat_file(file_path):
+    """Return a FileEntry with the size, device, inode, mtime, link count and ctime of a file."""
+    st = os.stat(file_path)
+    return FileEntry(file_path, st.st_size, st.st_dev, st.st_ino, st.st_mtime_ns, st.st_nlink, st.st_ctime_ns)
+
+def _as_entry(file):
+    """Return file as a FileEntry, stat'ing it only if it is a plain path."""
+    if isinstance(file, FileEntry):
+        return file
+    return stat_file(file)
+
+def _same_entry(entry):
+    return entry
+
+def _entry_path(entry):
+    return entry.path
+
+def _new_stats():
+    """Return an empty per-stage statistics dictionary."""
+    stats = {stage: {"files": 0, "bytes_read": 0, "cached": 0, "seconds": 0.0} for stage in ("size", "partial", "full")}
+    stats["size"]["hardlinks"] = 0
+    stats["partial"]["errors"] = stats["full"]["errors"] = 0
+    return stats
+
+def _full_checksum(file_path, file_size, read_size=DEFAULT_READ_SIZE, algorithm="md5", cancel=None):
+    """Adapter so generate_checksum can be called with the same arguments as generate_partial_checksum."""
+    return generate_checksum(file_path, read_size=read_size, algorithm=algorithm, cancel=cancel)
+
+def organize_files_by_checksum(files, stats=None, workers=DEFAULT_WORKERS, io_concurrency=None,
+                               use_processes=False, read_size=DEFAULT_READ_SIZE, index=None, progress=None,
+                               cancel=None, algorithm="md5", on_group=None, compact=False, hardlinks=None):
+    """
+    Organize files by checksum (grouping duplicates).
+
+    Files are narrowed down in stages so that only files which can still have a
+    duplicate are read:
+        1. group by size and drop sizes that occur only once,
+        2. hash the first and last PARTIAL_HASH_SIZE bytes and drop unique results,
+        3. run a full hash over the files that still collide.
+    Stages 2 and 3 hash their files concurrently on a worker pool. A file's
+    partial hash is started as soon as a second file of the same size shows
+    up, so when files is a stream such as scan_directory() the walk and the
+    hashing overlap. The result does not depend on the number of workers.
+
+    Files are tracked by (device, inode): only the first path seen for an
+    inode is hashed and grouped, so a file is never reported as a duplicate
+    of another name for itself, whether that name is a hard link or the same
+    path reached twice through overlapping directories.
+
+    A file that is deleted or becomes unreadable before it is hashed is
+    logged, counted and left out of its group (and of the index); the rest of
+    the scan goes on.
+
+    Parameters:
+        files (iterable): File paths or FileEntry records to compare. FileEntry
+            records are not stat'ed again.
+        stats (dict, optional): If given, filled with the number of files that
+            entered each stage ("size", "partial", "full"), the bytes read, the
+            number of checksums taken from the index ("cached") and the time
+            until the stage finished ("seconds"). The size stage also counts
+            the extra paths of an inode it skipped ("hardlinks"), and the
+            hash stages count the files that could not be read ("errors").
+        workers (int): Number of hashing threads (or processes). 1 hashes serially.
+        io_concurrency (int, optional): Maximum number of files read at once.
+        use_processes (bool): Hash in a process pool instead of a thread pool.
+        read_size (int): Size of each read in the full hash stage.
+        index (ChecksumIndex, optional): Persistent index. Checksums of unchanged
+            files are taken from it and newly computed checksums are stored in it.
+        progress (callable, optional): Called after each file of a stage as
+            progress(stage, files_done, bytes_done, files_total, bytes_total).
+            In the size stage bytes_done counts the bytes of the files seen and
+            the totals are None until the walk is over; in the hash stages it
+            counts bytes read, which excludes cached checksums.
+        cancel (threading.Event, optional): When set, the scan stops and
+            ScanCancelled is raised. Full hashes in a thread pool also check
+            it between blocks, so a large file does not delay the stop.
+        algorithm (str): hashlib algorithm used for all checksums. The index
+            must have been opened with the same algorithm.
+        on_group (callable, optional): Called as on_group(checksum, size, paths)
+            as soon as a duplicate group is complete, while the remaining
+            groups are still being hashed.
+        compact (bool): Keep files in a CompactFileTable and the duplicate
+            groups in a CompactDuplicateIndex instead of in Python objects per
+            file. Meant for trees with tens of millions of files.
+        hardlinks (dict, optional): If given, filled with the other names
+            of hard-linked files, as {first path: [other paths]}. Pass it to
+            build_removal_plan() so that every name of a duplicate inode is
+            removed and its space is really reclaimed.
+
+    Returns:
+        dict: Checksums mapped to lists of file paths that share them. Only
+        checksums shared by more than one file are included. With compact,
+        a DuplicateGroupsView that can be used like that dict.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(_new_stats())
+    start_time = time.perf_counter()
+
+    def check_cancel():
+        if cancel is not None and cancel.is_set():
+            raise ScanCancelled()
+
+    # Files are referred to by a key: the FileEntry itself, or its row in the file table in compact mode
+    file_table = duplicate_index = None
+    if compact:
+        from compact_index import CompactFileTable, CompactDuplicateIndex
+        file_table = CompactFileTable()
+        duplicate_index = CompactDuplicateIndex(file_table)
+        store, load, path_of = file_table.add, file_table.entry, file_table.path
+    else:
+        store = load = _same_entry
+        path_of = _entry_path
+
+    size_dict = {}
+    partial_futures = {}    # key -> Future of the partial checksum, or the checksum itself if it was cached
+    cached_full = {}        # key -> full checksum from the index, only for files that have one
+    candidate_inodes = {}   # (dev, inode) -> key, for files whose size occurs more than once
+    # An Event cannot be sent to another process, so hashes in a process pool only stop between files
+    hash_cancel = None if use_processes and workers > 1 else cancel
+    with _hash_pool(workers, io_concurrency, use_processes) as submit:
+
+        def start_partial(key, entry):
+            if index is not None:
+                cached_partial, full = index.lookup(entry)
+                if full is not None:
+                    cached_full[key] = full
+                if cached_partial is not None:
+                    partial_futures[key] = cached_partial
+                    return
+            partial_futures[key] = submit(generate_partial_checksum, entry.path, entry.size, PARTIAL_HASH_SIZE,
+                                          algorithm)
+
+        def inode_of(key):
+            if compact:
+                return file_table.devs[key], file_table.inodes[key]
+            return key.dev, key.inode
+
+        # Stage 1: size bucketing, no file contents are read
+        bytes_seen = 0
+        for file in files:
+            check_cancel()
+            try:
+                entry = _as_entry(file)
+            except OSError:
+                continue
+            # Only the first path of an inode takes part in the comparison. Every name of
+            # an inode has the same size, so only the files of that size are checked.
+            inode_key = (entry.dev, entry.inode)
+            size_group = size_dict.get(entry.size)
+            if size_group is None:
+                first_key = None
+            elif type(size_group) is list:
+                first_key = candidate_inodes.get(inode_key)
+            else:
+                first_key = size_group if inode_of(size_group) == inode_key else None
+            if first_key is not None:
+                stats["size"]["hardlinks"] += 1
+                if hardlinks is not None and entry.nlink > 1:
+                    first_path = path_of(first_key)
+                    other_names = hardlinks.setdefault(first_path, [])
+                    if entry.path != first_path and entry.path not in other_names:
+                        other_names.append(entry.path)
+                continue
+
+            key = store(entry)
+            if size_group is None:
+                # Most sizes occur only once, so a lone file is kept without a list
+                size_dict[entry.size] = key
+            elif type(size_group) is list:
+                size_group.append(key)
+                candidate_inodes[inode_key] = key
+                start_partial(key, entry)
+            else:
+                size_dict[entry.size] = [size_group, key]
+                candidate_inodes[inode_of(size_group)] = size_group
+                candidate_inodes[inode_key] = key
+                start_partial(size_group, load(size_group))
+                start_partial(key, entry)
+            stats["size"]["files"] += 1
+            bytes_seen += entry.size
+            if progress is not None:
+                progress("size", stats["size"]["files"], bytes_seen, None, None)
+        if progress is not None:
+            # The walk is over, so the totals of the size stage are now known
+            progress("size", stats["size"]["files"], bytes_seen, stats["size"]["files"], bytes_seen)
+        stats["size"]["seconds"] = time.perf_counter() - start_time
+        candidate_inodes = None  # Only needed while files arrive
+
+        # Checksums are written to the index in batches as soon as they are final, so none are kept per file
+        index_rows = []
+
+        def record(key, partial_checksum, full_checksum):
+            if index is None:
+                return
+            index_rows.append((load(key), partial_checksum, full_checksum))
+            if len(index_rows) >= INDEX_BATCH_SIZE:
+                index.store_many(index_rows)
+                index_rows.clear()
+
+        # Stage 2: collect the partial hashes of the head and tail of each candidate
+        candidate_count = len(partial_futures)
+        partial_bytes_total = sum(min(file_size, 2 * PARTIAL_HASH_SIZE) for file_size, size_group in size_dict.items()
+                                  if type(size_group) is list
+                                  for key in size_group if type(partial_futures[key]) is not str)
+        partial_dict = {}
+        for file_size, size_group in size_dict.items():
+            if type(size_group) is not list:
+                continue
+            for key in size_group:
+                check_cancel()
+                pending = partial_futures.pop(key)
+                stats["partial"]["files"] += 1
+                if type(pending) is str:
+                    partial_checksum = pending
+                    stats["partial"]["cached"] += 1
+                else:
+                    try:
+                        partial_checksum = pending.result()
+                    except OSError as e:
+                        logger.error(f"Skipping {path_of(key)}: {e}")
+                        stats["partial"]["errors"] += 1
+                        continue
+                    stats["partial"]["bytes_read"] += min(file_size, 2 * PARTIAL_HASH_SIZE)
+                partial_dict.setdefault((file_size, partial_checksum), []).append(key)
+                if progress is not None:
+                    progress("partial", stats["partial"]["files"], stats["partial"]["bytes_read"],
+                             candidate_count, partial_bytes_total)
+        stats["partial"]["seconds"] = time.perf_counter() - start_time
+        size_dict = None
+
+        def add_group(checksum, file_size, keys):
+            file_group = [path_of(key) for key in keys]
+            if compact:
+                for key in keys:
+                    duplicate_index.add(key, checksum)
+            else:
+                checksum_dict[checksum] = file_group
+            if on_group is not None:
+                on_group(checksum, file_size, file_group)
+
+        # Stage 3: full hash of the files that still collide
+        checksum_dict = {}
+        full_buckets = []
+        for (file_size, partial_checksum), partial_group in partial_dict.items():
+            if len(partial_group) < 2 or file_size <= 2 * PARTIAL_HASH_SIZE:
+                # A small file's partial hash already covered the whole file
+                full_checksum = partial_checksum if file_size <= 2 * PARTIAL_HASH_SIZE else None
+                for key in partial_group:
+                    record(key, partial_checksum, full_checksum)
+                if len(partial_group) > 1:
+                    add_group(partial_checksum, file_size, partial_group)
+                continue
+            bucket = []
+            for key in partial_group:
+                cached = cached_full.pop(key, None)
+                if cached is not None:
+                    bucket.append((key, cached))
+                else:
+                    bucket.append((key, submit(_full_checksum, path_of(key), file_size, read_size, algorithm,
+                                               hash_cancel)))
+            full_buckets.append((file_size, partial_checksum, bucket))
+        partial_dict = cached_full = None
+
+        full_files_total = sum(len(bucket) for _, _, bucket in full_buckets)
+        full_bytes_total = sum(file_size for file_size, _, bucket in full_buckets for _, pending in bucket
+                               if type(pending) is not str)
+        for file_size, partial_checksum, bucket in full_buckets:
+            # A bucket's groups are final once all of its files are hashed
+            full_dict = {}
+            for key, pending in bucket:
+                check_cancel()
+                stats["full"]["files"] += 1
+                if type(pending) is str:
+                    full_checksum = pending
+                    stats["full"]["cached"] += 1
+                else:
+                    try:
+                        full_checksum = pending.result()
+                    except OSError as e:
+                        # Its partial checksum may be stale as well, so the index does not get it
+                        logger.error(f"Skipping {path_of(key)}: {e}")
+                        stats["full"]["errors"] += 1
+                        continue
+                    stats["full"]["bytes_read"] += file_size
+                full_dict.setdefault(full_checksum, []).append(key)
+                record(key, partial_checksum, full_checksum)
+                if progress is not None:
+                    progress("full", stats["full"]["files"], stats["full"]["bytes_read"],
+                             full_files_total, full_bytes_total)
+            for checksum, full_group in full_dict.items():
+                if len(full_group) > 1:
+                    add_group(checksum, file_size, full_group)
+        stats["full"]["seconds"] = time.perf_counter() - start_time
+
+    if index_rows:
+        index.store_many(index_rows)
+    if compact:
+        return duplicate_index.duplicate_groups()
     return checksum_dict
@@ -0,0 +1,185 @@
+# Scrollable, searchable curses pager for log files of any size.
+
+import mmap
+import curses
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy  # Optional, makes indexing line offsets much faster
+except ImportError:
+    numpy = None
+
+# Number of bytes scanned for line breaks at a time
+INDEX_CHUNK_SIZE = 16 * 1024 * 1024
+
+class LineIndex:
+    """
+    Byte offsets of the lines of a file, read through mmap.
+
+    The index is extended chunk by chunk only as far as it is needed, so
+    opening a multi-GB log is instant and the file is never read into
+    memory. Jumping to the end indexes the rest of the file once; after that
+    any line is a lookup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = self._file.seek(0, 2)
+        # An empty file cannot be mapped
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.offsets = array('Q', [0] if self.size else [])
+        self._indexed_to = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def complete(self):
+        """True once the whole file has been indexed."""
+        return self._indexed_to >= self.size
+
+    def _extend(self):
+        """Index the line starts in the next chunk of the file."""
+        start = self._indexed_to
+        end = min(start + INDEX_CHUNK_SIZE, self.size)
+        if numpy is not None:
+            chunk = numpy.frombuffer(self._data, dtype=numpy.uint8, count=end - start, offset=start)
+            line_starts = numpy.flatnonzero(chunk == ord('\n')) + (start + 1)
+            # A line break at the very end of the file does not start another line
+            line_starts = line_starts[line_starts < self.size]
+            self.offsets.frombytes(line_starts.astype(numpy.uint64).tobytes())
+            del chunk
+        else:
+            position = self._data.find(b'\n', start, end)
+            while position != -1:
+                if position + 1 < self.size:
+                    self.offsets.append(position + 1)
+                position = self._data.find(b'\n', position + 1, end)
+        self._indexed_to = end
+
+    def has_line(self, line_number):
+        """Return True if the file has a line with this (0-based) number."""
+        while line_number >= len(self.offsets) and not self.complete:
+            self._extend()
+        return 0 <= line_number < len(self.offsets)
+
+    def line_count(self):
+        """Return the number of lines, indexing the rest of the file if needed."""
+        while not self.complete:
+            self._extend()
+        return len(self.offsets)
+
+    def line(self, line_number):
+        """Return the text of a line without its line break."""
+        if not self.has_line(line_number):
+            raise IndexError(line_number)
+        start = self.offsets[line_number]
+        end = self.offsets[line_number + 1] if self.has_line(line_number + 1) else self.size
+        return self._data[start:end].rstrip(b'\r\n').decode('utf-8', errors='replace')
+
+    def line_at(self, offset):
+        """Return the number of the line that contains a byte offset."""
+        while offset >= self._indexed_to and not self.complete:
+            self._extend()
+        return bisect_right(self.offsets, offset) - 1
+
+    def find(self, text, start_line=0):
+        """Return the number of the first line at or after start_line that contains text, or None."""
+        if not self.has_line(start_line):
+            return None
+        position = self._data.find(text.encode('utf-8'), self.offsets[start_line])
+        return None if position == -1 else self.line_at(position)
+
+    def close(self):
+        """Unmap and close the file."""
+        if self.size:
+            self._data.close()
+        self._file.close()
+
+def _prompt(stdscr, y, prompt):
+    """Read a line of text at the bottom of the screen."""
+    max_x = stdscr.getmaxyx()[1]
+    stdscr.move(y, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(y, 0, prompt[:max_x - 1])
+    curses.echo()
+    curses.curs_set(1)
+    try:
+        text = stdscr.getstr(y, len(prompt), max(max_x - len(prompt) - 1, 1))
+    finally:
+        curses.noecho()
+        curses.curs_set(0)
+    return text.decode('utf-8', errors='replace')
+
+def _last_top(index, height):
+    """Return the first line shown when the end of the file is at the bottom of the screen."""
+    return max(index.line_count() - height, 0)
+
+def show_log_pager(stdscr, path):
+    """
+    Show a file in a scrollable pager until the user quits.
+
+    Keys: Up/Down (or k/j) scroll a line, PgUp/PgDn (or b/space) a page,
+    g/Home and G/End jump to the start and the end, / searches, n finds the
+    next match and q or Esc quits.
+    """
+    with LineIndex(path) as index:
+        top = 0
+        pattern = None
+        message = ""
+        while True:
+            max_y, max_x = stdscr.getmaxyx()
+            height = max(max_y - 2, 1)
+
+            stdscr.erase()
+            stdscr.addstr(0, 0, f"===== {path} ====="[:max_x - 1], curses.A_BOLD)
+            shown = 0
+            while shown < height and index.has_line(top + shown):
+                text = index.line(top + shown).expandtabs().replace('\0', '')
+                stdscr.addstr(shown + 1, 0, text[:max_x - 1])
+                shown += 1
+
+            total = str(len(index.offsets)) if index.complete else f"{len(index.offsets)}+"
+            status = message or "Up/Down PgUp/PgDn g/G scroll  / search  n next  q quit"
+            status_line = f"Lines {min(top + 1, top + shown)}-{top + shown} of {total}  {status}"
+            stdscr.addstr(max_y - 1, 0, status_line[:max_x - 1], curses.A_REVERSE)
+            stdscr.refresh()
+            message = ""
+
+            key = stdscr.getch()
+            if key in (ord('q'), ord('Q'), 27):
+                return
+            elif key in (curses.KEY_DOWN, ord('j')):
+                if index.has_line(top + height):
+                    top += 1
+            elif key in (curses.KEY_UP, ord('k')):
+                top = max(top - 1, 0)
+            elif key in (curses.KEY_NPAGE, ord(' ')):
+                top = top + height if index.has_line(top + 2 * height - 1) else _last_top(index, height)
+            elif key in (curses.KEY_PPAGE, ord('b')):
+                top = max(top - height, 0)
+            elif key in (curses.KEY_HOME, ord('g')):
+                top = 0
+            elif key in (curses.KEY_END, ord('G')):
+                top = _last_top(index, height)
+            elif key in (ord('/'), ord('n')):
+                if key == ord('/'):
+                    pattern = _prompt(stdscr, max_y - 1, "/") or pattern
+                    start_line = top
+                else:
+                    start_line = top + 1
+                if not pattern:
+                    continue
+                match = index.find(pattern, start_line)
+                if match is None and start_line > 0:
+                    match = index.find(pattern, 0)
+                    message = "Search wrapped to the top"
+                if match is None:
+                    message = f"Pattern not found: {pattern}"
+                else:
+                    top = match
@@ -1,29 +1,67 @@
 # Handles logging to both the terminal and a log file.
 
+import atexit
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-def setup_logger(log_to_file=True):
-    """Set up a logger that logs to both terminal and a file."""
-    logger = logging.getLogger('DuplicationRemover')
-    logger.setLevel(logging.INFO)
+LOGGER_NAME = 'DuplicationRemover'
+LOG_FILE = 'removal_log.txt'
+
+# The log file is rotated to removal_log.txt.1, .2, ... once it reaches this size
+MAX_LOG_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 
-    # Create handlers
-    console_handler = logging.StreamHandler()
-    file_handler = logging.FileHandler('removal_log.txt')
+# The listener of the current configuration, so setup_logger can be called again safely
+_listener = None
+
+def setup_logger(log_to_file=True, log_to_console=True, log_file=LOG_FILE,
+                 max_bytes=MAX_LOG_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """
+    Set up a logger that logs to the terminal and/or a rotating log file.
+
+    Records are only put on a queue by the calling thread; a background
+    QueueListener formats them and does the writing, so logging never waits
+    for the disk or the terminal. Calling setup_logger again replaces the
+    previous handlers instead of adding a second set.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.INFO)
+    stop_logger()
 
     # Create formatter
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    
-    # Set formatter for handlers
-    console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
 
-    # Add handlers to the logger
-    logger.addHandler(console_handler)
+    # Create the handlers that do the actual writing
+    handlers = []
+    if log_to_console:
+        handlers.append(logging.StreamHandler())
     if log_to_file:
-        logger.addHandler(file_handler)
+        handlers.append(RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                            encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
 
-    return logger
+    # The logger itself only enqueues records
+    log_queue = queue.Queue()
+    logger.addHandler(QueueHandler(log_queue))
 
+    global _listener
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return logger
 
+def stop_logger():
+    """Write out the queued records and remove the handlers added by setup_logger."""
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
 
+atexit.register(stop_logger)
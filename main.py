@@ -1,18 +1,31 @@
 import os
+import time
+import queue
 import curses
-import shutil
-from file_handler import get_files_in_directory, organize_files_by_checksum
-from ddas import remove_duplicates
-from logger import setup_logger
-import send2trash
+import threading
+from file_handler import scan_directory, organize_files_by_checksum, ScanCancelled
+from ddas import build_removal_plan, write_removal_plan, execute_removal_plan
+from checksum_index import ChecksumIndex
+from tree_hash import find_duplicate_directories
+from logger import setup_logger, LOG_FILE
+from log_pager import show_log_pager
 
-# Global logger for terminal output
-logger = setup_logger()
+# Global logger; console output is off because it would draw over the curses screen
+logger = setup_logger(log_to_console=False)
 
 # Constants for UI layout
 HEADER = "===== Data Duplication Removal ===="
 FOOTER = "Press any key to return to the menu."
 
+# File the removal plan is written to in dry-run mode
+PLAN_FILE = "removal_plan.jsonl"
+
+# Number of times per second the progress screen is redrawn
+FRAME_RATE = 10
+
+# Progress stages in display order
+STAGE_LABELS = {"size": "Scanning", "partial": "Partial hash", "full": "Full hash", "remove": "Removing"}
+
 # Utility Functions
 def display_message(stdscr, message, x=0, y=0, highlight=False):
     """Display a message with optional highlighting."""
@@ -31,15 +44,17 @@ def display_message(stdscr, message, x=0, y=0, highlight=False):
         logger.error("Message cannot be displayed because the screen is too small.")
 
 def get_deletion_mode(stdscr):
-    """Prompt the user to select a deletion mode (trash or permanent)."""
+    """Prompt the user to select a deletion mode (trash, permanent, link or dry run)."""
     try:
         stdscr.clear()
         max_y, max_x = stdscr.getmaxyx()
-        if max_y >= 12:
+        if max_y >= 15:
             stdscr.addstr(8, 0, "Choose deletion mode:")
             stdscr.addstr(9, 0, "1. Send to Trash")
             stdscr.addstr(10, 0, "2. Permanently Delete")
-            stdscr.addstr(12, 0, "Select an option (1-2): ")
+            stdscr.addstr(11, 0, "3. Replace with Links (reflink or hard link)")
+            stdscr.addstr(12, 0, f"4. Dry Run (only write the removal plan to {PLAN_FILE})")
+            stdscr.addstr(14, 0, "Select an option (1-4): ")
             stdscr.refresh()
 
             while True:
@@ -48,6 +63,10 @@ def get_deletion_mode(stdscr):
                     return "trash"
                 elif key == ord('2'):
                     return "permanent"
+                elif key == ord('3'):
+                    return "link"
+                elif key == ord('4'):
+                    return "dry-run"
         else:
             display_message(stdscr, "Terminal window is too small. Please resize.", 0, 0)
     except curses.error as e:
@@ -105,22 +124,188 @@ def display_progress(stdscr, progress, total, y_pos=5):
         logger.error(f"Error displaying progress: {e}")
         display_message(stdscr, "Error displaying progress.", 0, 0)
 
-# File Handling Functions
-def move_to_trash(file_path):
-    """Move a file to the trash."""
+def format_bytes(num_bytes):
+    """Format a number of bytes with a binary unit, e.g. 1.5 GB."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024:
+            return f"{num_bytes} B" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+def format_duration(seconds):
+    """Format a number of seconds as h:mm:ss or m:ss."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def display_stage_progress(stdscr, stage, state, y_pos):
+    """
+    Display the progress of one stage: files, bytes, throughput and ETA.
+
+    Returns the next free line.
+    """
+    max_y, max_x = stdscr.getmaxyx()
+    if y_pos >= max_y - 1:
+        return y_pos
+    elapsed = max(time.monotonic() - state["started"], 1e-6)
+    files_rate = state["files"] / elapsed
+    bytes_rate = state["bytes"] / elapsed
+
+    files_str = f"{state['files']}" if state["files_total"] is None else f"{state['files']}/{state['files_total']}"
+    line = f"{STAGE_LABELS[stage]:<13} {files_str} files  {format_bytes(state['bytes'])}"
+    if state["bytes_total"] is not None:
+        line += f"/{format_bytes(state['bytes_total'])}"
+    line += f"  {bytes_rate / (1024 * 1024):.1f} MB/s  {files_rate:.0f} files/s"
+
+    # Estimate the remaining time from bytes where they are known, else from files
+    eta = None
+    if state["bytes_total"] and bytes_rate > 0:
+        eta = (state["bytes_total"] - state["bytes"]) / bytes_rate
+    elif state["files_total"] and files_rate > 0:
+        eta = (state["files_total"] - state["files"]) / files_rate
+    if eta is not None:
+        line += f"  ETA {format_duration(eta)}"
+    stdscr.addstr(y_pos, 0, line[:max_x - 1])
+
+    if state["files_total"]:
+        display_progress(stdscr, state["files"], state["files_total"], y_pos + 1)
+        return y_pos + 2
+    return y_pos + 1
+
+def _progress_reporter(updates, interval):
+    """Return a progress callback that sends at most one update per stage and interval to the updates queue."""
+    last_sent = {}
+
+    def report(stage, files_done, bytes_done, files_total=None, bytes_total=None):
+        now = time.monotonic()
+        finished = files_total is not None and files_done >= files_total
+        if finished or now - last_sent.get(stage, 0.0) >= interval:
+            last_sent[stage] = now
+            updates.put(("progress", stage, files_done, bytes_done, files_total, bytes_total))
+
+    return report
+
+def run_duplication_removal(directory, deletion_mode, updates, cancel):
+    """
+    Scan a directory, hash the candidates and remove the duplicates.
+
+    Runs in a background thread. Progress and the final message are sent to
+    the updates queue, and the work stops early once cancel is set.
+    """
+    report = _progress_reporter(updates, 1.0 / FRAME_RATE)
     try:
-        if os.name == 'nt':  # For Windows
-            send2trash.send2trash(file_path)
-        else:  # For Unix-based systems
-            trash_dir = os.path.expanduser('~/.local/share/Trash/files')
-            if not os.path.exists(trash_dir):
-                os.makedirs(trash_dir)
-            shutil.move(file_path, trash_dir)
+        logger.info(f"Starting scan of directory: {directory}")
+
+        # Stream files from the walker straight into the checksum stages
+        scan_stats = {}
+        hardlinks = {}
+        with ChecksumIndex() as index:
+            checksum_dict = organize_files_by_checksum(scan_directory(directory), scan_stats, index=index,
+                                                       progress=report, cancel=cancel, hardlinks=hardlinks)
+            pruned = index.prune([directory])
+        logger.info(f"Checksum index: {index.hits} cached, {index.misses} hashed, {pruned} stale entries pruned")
+
+        # Log total files scanned
+        logger.info(f"Total files scanned: {scan_stats['size']['files']}")
+        for stage, stage_stats in scan_stats.items():
+            logger.info(f"Stage '{stage}': {stage_stats['files']} files, {stage_stats['bytes_read']} bytes read, "
+                        f"{stage_stats['cached']} from index")
+
+        # Whole copied directories are removed as one unit instead of file by file
+        directory_groups = find_duplicate_directories(checksum_dict, [directory])
+        for group in directory_groups:
+            logger.info(f"Identical directories ({group.file_count} files, {group.size} bytes each): "
+                        f"{', '.join(group.directories)}")
+
+        # Decide what to keep and what to remove before touching any file
+        plan = build_removal_plan(checksum_dict, directory_groups=directory_groups, hardlinks=hardlinks)
+        if deletion_mode == "dry-run":
+            write_removal_plan(plan, PLAN_FILE)
+            duplicate_count = sum(len(group.remove) for group in plan)
+            logger.info(f"Dry run: {duplicate_count} duplicates written to {PLAN_FILE}")
+            updates.put(("done", f"Dry run: {duplicate_count} duplicates written to {PLAN_FILE}"))
+            return
+
+        result = execute_removal_plan(
+            plan, deletion_mode, cancel=cancel,
+            progress=lambda processed, total: report("remove", processed, 0, total),
+        )
+        if cancel.is_set():
+            message = f"Cancelled. Duplicates removed: {result.removed}"
+        else:
+            message = f"Total duplicates removed: {result.removed}"
+        if result.errors:
+            message += f", {result.errors} could not be removed (see logs)"
+        updates.put(("done", message))
+    except ScanCancelled:
+        logger.info("Scan cancelled by user.")
+        updates.put(("done", "Scan cancelled."))
     except Exception as e:
-        logger.error(f"Error sending file to trash: {file_path} - {e}")
-        return False
-    return True
+        logger.error(f"Unexpected error during duplication removal: {e}")
+        updates.put(("done", "An unexpected error occurred. Please check logs."))
+
+def show_background_progress(stdscr, directory, deletion_mode):
+    """
+    Run the duplication removal in a background thread and show its progress.
+
+    The screen is redrawn FRAME_RATE times per second from the updates the
+    worker sends. Pressing 'q' or Esc cancels the work.
+
+    Returns:
+        str: The final message reported by the worker.
+    """
+    updates = queue.Queue()
+    cancel = threading.Event()
+    worker = threading.Thread(target=run_duplication_removal, name="ddas-worker",
+                              args=(directory, deletion_mode, updates, cancel), daemon=True)
+    worker.start()
+
+    stages = {}
+    result = None
+    stdscr.timeout(1000 // FRAME_RATE)
+    try:
+        while result is None:
+            key = stdscr.getch()
+            if key in (ord('q'), 27) and not cancel.is_set():
+                cancel.set()
+                logger.info("User requested cancellation.")
 
+            # Keep only the newest state of every stage
+            while True:
+                try:
+                    message = updates.get_nowait()
+                except queue.Empty:
+                    break
+                if message[0] == "done":
+                    result = message[1]
+                    break
+                _, stage, files_done, bytes_done, files_total, bytes_total = message
+                state = stages.setdefault(stage, {"started": time.monotonic()})
+                state.update(files=files_done, bytes=bytes_done, files_total=files_total, bytes_total=bytes_total)
+
+            try:
+                stdscr.erase()
+                stdscr.addstr(0, 0, HEADER)
+                max_y, max_x = stdscr.getmaxyx()
+                stdscr.addstr(2, 0, f"Directory: {directory}"[:max_x - 1])
+                y_pos = 4
+                for stage in STAGE_LABELS:
+                    if stage in stages:
+                        y_pos = display_stage_progress(stdscr, stage, stages[stage], y_pos)
+                if max_y > y_pos + 1:
+                    status = "Cancelling..." if cancel.is_set() else "Press 'q' or Esc to cancel."
+                    stdscr.addstr(y_pos + 1, 0, status)
+                stdscr.refresh()
+            except curses.error:
+                pass  # The window is too small for a full frame, try again next frame
+    finally:
+        stdscr.timeout(-1)
+        # On Ctrl+C or a drawing error, stop the worker instead of waiting for the whole plan
+        cancel.set()
+        worker.join()
+    return result
+
+# File Handling Functions
 def start_duplication_removal(stdscr):
     """Start the file duplication removal process and show progress."""
     try:
@@ -136,67 +321,23 @@ def start_duplication_removal(stdscr):
             logger.info("User chose to send duplicates to trash.")
         elif deletion_mode == "permanent":
             logger.info("User chose to permanently delete duplicates.")
-
-        display_message(stdscr, f"Scanning directory {directory}...", 0, 4)
-        stdscr.refresh()
-        logger.info(f"Starting scan of directory: {directory}")
-
-        # Get files and organize by checksum
-        files = get_files_in_directory(directory)
-        checksum_dict = organize_files_by_checksum(files)
-
-        # Log total files scanned
-        total_files = len(files)
-        logger.info(f"Total files scanned: {total_files}")
-
-        # Log duplicate removal progress
-        total_duplicates_removed = 0
-        files_processed = 0
-
-        for checksum, file_group in checksum_dict.items():
-            if len(file_group) > 1:
-                for file in file_group[1:]:
-                    if deletion_mode == "trash":
-                        if move_to_trash(file):
-                            total_duplicates_removed += 1
-                            logger.info(f"Moved duplicate to trash: {file}")
-                    elif deletion_mode == "permanent":
-                        try:
-                            os.remove(file)  # Permanently delete the file
-                            total_duplicates_removed += 1
-                            logger.info(f"Permanently deleted duplicate: {file}")
-                        except Exception as e:
-                            logger.error(f"Error deleting file {file}: {e}")
-                    files_processed += 1
-                    display_progress(stdscr, files_processed, total_files)
-
-        display_message(stdscr, f"Total duplicates removed: {total_duplicates_removed}", 0, 7)
-        logger.info(f"Total duplicates removed: {total_duplicates_removed}")
-        stdscr.refresh()
+        elif deletion_mode == "link":
+            logger.info("User chose to replace duplicates with links.")
+        elif deletion_mode == "dry-run":
+            logger.info("User chose a dry run.")
+
+        result = show_background_progress(stdscr, directory, deletion_mode)
+        display_message(stdscr, result, 0, stdscr.getmaxyx()[0] - 3)
+        display_message(stdscr, FOOTER, 0, stdscr.getmaxyx()[0] - 2)
         stdscr.getch()
     except Exception as e:
         logger.error(f"Unexpected error during duplication removal: {e}")
         display_message(stdscr, "An unexpected error occurred. Please check logs.", 0, 0)
 
 def view_logs(stdscr):
-    """Display log file contents in the terminal."""
+    """Display the log file in a scrollable, searchable pager."""
     try:
-        log_file_path = 'removal_log.txt'
-
-        with open(log_file_path, 'r') as file:
-            stdscr.clear()
-            stdscr.addstr(0, 0, "===== Log Contents =====")
-            lines = file.readlines()
-            
-            for i, line in enumerate(lines):
-                stdscr.addstr(i + 1, 0, line.strip())
-                if i >= curses.LINES - 3:
-                    stdscr.addstr(i + 2, 0, "-- More lines in the log file --")
-                    break
-
-            stdscr.addstr(curses.LINES - 2, 0, "Press any key to return to the menu.")
-            stdscr.refresh()
-            stdscr.getch()
+        show_log_pager(stdscr, LOG_FILE)
     except FileNotFoundError:
         logger.error("Log file not found.")
         display_message(stdscr, "Log file not found.", 0, 6)
@@ -0,0 +1,36 @@
+# Tests for the persistent checksum index: a cached checksum must never outlive a change to the file.
+
+import os
+import time
+from checksum_index import ChecksumIndex
+from file_handler import organize_files_by_checksum, walk_files
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def _scan(root, index):
+    return organize_files_by_checksum(sorted(walk_files(root), key=lambda entry: entry.path),
+                                      workers=1, index=index)
+
+def test_edit_with_restored_mtime_is_hashed_again(tmp_path):
+    root = tmp_path / "R"
+    root.mkdir()
+    content = b"identical content\n" * 1000
+    for name in ("a", "b"):
+        _write(root / name, content)
+    index_path = str(tmp_path / "index.db")
+    with ChecksumIndex(index_path) as index:
+        assert len(_scan(str(root), index)) == 1
+
+    # Edit b in place without changing its size, then put its mtime back
+    st = os.stat(root / "b")
+    time.sleep(0.05)  # ctime is taken from a coarse clock
+    with open(root / "b", 'r+b') as f:
+        f.write(b"EDITED")
+    os.utime(root / "b", ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.stat(root / "b").st_mtime_ns == st.st_mtime_ns
+
+    with ChecksumIndex(index_path) as index:
+        assert len(_scan(str(root), index)) == 0
+        assert index.hits == 1
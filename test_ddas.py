@@ -0,0 +1,158 @@
+# Regression tests for the removal plan: no plan may remove every copy of a file or directory.
+
+import os
+import time
+import threading
+import pytest
+from file_handler import ScanCancelled, generate_checksum, organize_files_by_checksum, walk_files
+from tree_hash import find_duplicate_directories
+from ddas import build_removal_plan, execute_removal_plan, read_removal_plan, write_removal_plan
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def _set_mtime(path, seconds):
+    os.utime(path, (seconds, seconds))
+
+def _edit_in_place(path):
+    # Same size, same mtime: only the contents and the ctime change
+    file_stat = os.stat(path)
+    time.sleep(0.05)  # ctime is taken from a coarse clock
+    with open(path, 'r+b') as f:
+        f.write(b"EDITED")
+    os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+def _plan(root, keep, preferred_root=None, hardlinks=None):
+    checksum_dict = organize_files_by_checksum(sorted(walk_files(root), key=lambda entry: entry.path), workers=1,
+                                               hardlinks=hardlinks)
+    directory_groups = find_duplicate_directories(checksum_dict, [root])
+    return build_removal_plan(checksum_dict, keep, preferred_root, directory_groups, hardlinks)
+
+def _assert_nothing_kept_is_removed(plan):
+    removed = {os.path.normpath(path) for group in plan for path in group.remove}
+    for group in plan:
+        kept = os.path.normpath(group.keep)
+        assert kept not in removed
+        parent = os.path.dirname(kept)
+        while parent != os.path.dirname(parent):
+            assert parent not in removed, f"{group.keep} is inside removed directory {parent}"
+            parent = os.path.dirname(parent)
+
+def test_directory_containing_a_kept_directory_is_not_removed(tmp_path):
+    # R/{W,X,Y}/K/f are identical; X and Y contain only K, W also holds a unique file
+    root = str(tmp_path / "R")
+    content = b"shared content\n" * 100
+    for name in ("W", "X", "Y"):
+        _write(os.path.join(root, name, "K", "f"), content)
+    _write(os.path.join(root, "W", "unique"), b"only in W\n")
+
+    # X/K is the oldest K, but Y is older than X
+    _set_mtime(os.path.join(root, "X", "K"), 1000)
+    _set_mtime(os.path.join(root, "W", "K"), 2000)
+    _set_mtime(os.path.join(root, "Y", "K"), 3000)
+    _set_mtime(os.path.join(root, "Y"), 1500)
+    _set_mtime(os.path.join(root, "X"), 2500)
+    _set_mtime(os.path.join(root, "W"), 3500)
+
+    plan = _plan(root, "oldest")
+    _assert_nothing_kept_is_removed(plan)
+
+    result = execute_removal_plan(plan, "permanent", workers=4, batch_size=1)
+    assert result.errors == 0
+    remaining = [path for path in (os.path.join(root, name, "K", "f") for name in ("W", "X", "Y"))
+                 if os.path.exists(path)]
+    assert len(remaining) == 1
+    with open(remaining[0], 'rb') as f:
+        assert f.read() == content
+    assert os.path.exists(os.path.join(root, "W", "unique"))
+
+def test_file_inside_a_kept_directory_is_kept(tmp_path):
+    # A and B are identical directories; a loose copy of their file has the shortest path
+    root = str(tmp_path / "R")
+    content = b"directory content\n" * 100
+    _write(os.path.join(root, "AAAA", "file"), content)
+    _write(os.path.join(root, "BBBB", "file"), content)
+    _write(os.path.join(root, "f"), content)
+
+    plan = _plan(root, "shortest")
+    _assert_nothing_kept_is_removed(plan)
+    directory_plan = [group for group in plan if group.kind == "directory"]
+    assert [(group.keep, group.remove) for group in directory_plan] == \
+        [(os.path.join(root, "AAAA"), [os.path.join(root, "BBBB")])]
+    for group in plan:
+        assert os.path.join(root, "AAAA", "file") not in group.remove
+
+    result = execute_removal_plan(plan, "permanent", workers=4, batch_size=1)
+    assert result == (2, 0)
+    assert os.path.exists(os.path.join(root, "AAAA", "file"))
+    assert not os.path.exists(os.path.join(root, "BBBB"))
+    assert not os.path.exists(os.path.join(root, "f"))
+
+def test_unreadable_file_is_skipped(tmp_path):
+    # Three files of the same size; one disappears after the walk, before it is hashed
+    root = str(tmp_path / "R")
+    for name in ("a", "b", "c"):
+        _write(os.path.join(root, name), b"same size\n" * 1000)
+    entries = sorted(walk_files(root), key=lambda entry: entry.path)
+    os.remove(os.path.join(root, "c"))
+
+    stats = {}
+    checksum_dict = organize_files_by_checksum(entries, stats=stats, workers=1)
+    assert list(checksum_dict.values()) == [[os.path.join(root, "a"), os.path.join(root, "b")]]
+    assert stats["partial"]["errors"] == 1
+
+def test_cancel_stops_a_hash_between_blocks(tmp_path):
+    path = str(tmp_path / "large")
+    _write(path, b"\0" * (1024 * 1024))
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(ScanCancelled):
+        generate_checksum(path, read_size=4096, cancel=cancel)
+    with pytest.raises(ScanCancelled):
+        generate_checksum(path, read_size=4096, mmap_threshold=1, cancel=cancel)
+
+def test_saved_plan_skips_a_file_edited_after_planning(tmp_path):
+    root = str(tmp_path / "R")
+    _write(os.path.join(root, "a"), b"planned content\n" * 1000)
+    _write(os.path.join(root, "b"), b"planned content\n" * 1000)
+    plan_path = str(tmp_path / "plan.jsonl")
+    write_removal_plan(_plan(root, "first"), plan_path)
+
+    _edit_in_place(os.path.join(root, "b"))
+    result = execute_removal_plan(read_removal_plan(plan_path), "permanent", workers=1)
+    assert result == (0, 1)
+    with open(os.path.join(root, "b"), 'rb') as f:
+        assert f.read(6) == b"EDITED"
+
+def test_saved_plan_skips_a_directory_edited_after_planning(tmp_path):
+    root = str(tmp_path / "R")
+    for name in ("A", "B"):
+        _write(os.path.join(root, name, "x"), b"x content\n" * 1000)
+        _write(os.path.join(root, name, "y"), b"y content\n" * 1000)
+    plan_path = str(tmp_path / "plan.jsonl")
+    plan = _plan(root, "first")
+    assert [(group.kind, group.remove) for group in plan] == [("directory", [os.path.join(root, "B")])]
+    write_removal_plan(plan, plan_path)
+
+    _edit_in_place(os.path.join(root, "B", "x"))
+    result = execute_removal_plan(read_removal_plan(plan_path), "permanent", workers=1)
+    assert result == (0, 1)
+    assert os.path.exists(os.path.join(root, "B", "x"))
+
+def test_every_name_of_a_duplicate_is_linked(tmp_path):
+    # Relinking b changes the ctime of a (new link) and of b2 (one link less); neither counts as an edit
+    root = str(tmp_path / "R")
+    _write(os.path.join(root, "a"), b"linked content\n" * 1000)
+    _write(os.path.join(root, "b"), b"linked content\n" * 1000)
+    os.link(os.path.join(root, "b"), os.path.join(root, "b2"))
+    hardlinks = {}
+    plan = _plan(root, "first", hardlinks=hardlinks)
+    time.sleep(0.05)  # ctime is taken from a coarse clock
+
+    result = execute_removal_plan(plan, "link", workers=1)
+    assert result == (2, 0)
+    kept_inode = os.stat(os.path.join(root, "a")).st_ino
+    assert os.stat(os.path.join(root, "b")).st_ino == kept_inode
+    assert os.stat(os.path.join(root, "b2")).st_ino == kept_inode
@@ -0,0 +1,115 @@
+# Finds whole directories that are identical copies of each other, using Merkle-style tree hashes.
+
+import os
+import hashlib
+from collections import namedtuple
+
+# One set of identical directories: their tree hash, the bytes and files in each copy, and the copies
+DirectoryGroup = namedtuple('DirectoryGroup', ['tree_hash', 'size', 'file_count', 'directories'])
+
+def _candidate_directories(checksum_dict, roots):
+    """Return the directories below the roots that contain a duplicate file somewhere in their subtree."""
+    stop = {os.path.normpath(root) for root in roots}
+    candidates = set()
+    for file_group in checksum_dict.values():
+        for file in file_group:
+            directory = os.path.dirname(file)
+            while directory and directory not in candidates and os.path.normpath(directory) not in stop:
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    break  # The file is not below any of the roots
+                candidates.add(directory)
+                directory = parent
+    return candidates
+
+def _hash_directory(directory, digests, tree_hashes):
+    """
+    Return (tree_hash, size, file_count) of a directory, or None if it cannot be a duplicate.
+
+    The hash covers the sorted (kind, name, digest) triples of the directory's
+    children, where a subdirectory's digest is its own tree hash. A directory
+    is not hashable if it contains a file without a digest (a unique file, or
+    one the scan skipped), a symbolic link or anything else that is not a
+    regular file or directory, or if it cannot be read.
+    """
+    if directory in tree_hashes:
+        return tree_hashes[directory]
+
+    result = None
+    children = []
+    size = file_count = 0
+    try:
+        with os.scandir(directory) as scanner:
+            for dir_entry in scanner:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    subtree = _hash_directory(dir_entry.path, digests, tree_hashes)
+                    if subtree is None:
+                        break
+                    children.append((os.fsencode(dir_entry.name), b"d", subtree[0].encode()))
+                    size += subtree[1]
+                    file_count += subtree[2]
+                elif dir_entry.is_file(follow_symlinks=False) and dir_entry.path in digests:
+                    children.append((os.fsencode(dir_entry.name), b"f", digests[dir_entry.path].encode()))
+                    size += dir_entry.stat(follow_symlinks=False).st_size
+                    file_count += 1
+                else:
+                    break
+            else:
+                tree_hash = hashlib.sha256()
+                for name, kind, digest in sorted(children):
+                    tree_hash.update(kind + b" " + digest + b" " + name + b"\0")
+                result = (tree_hash.hexdigest(), size, file_count)
+    except OSError:
+        result = None
+
+    tree_hashes[directory] = result
+    return result
+
+def find_duplicate_directories(checksum_dict, roots):
+    """
+    Find directories whose whole subtrees are identical.
+
+    Every directory below the roots that contains a duplicate file gets a
+    Merkle-style hash built from the names and content digests of its
+    children, reusing the per-file checksums in checksum_dict. Two
+    directories with the same hash hold the same names, the same contents and
+    the same (possibly empty) subdirectories. A directory with any file that
+    is not in checksum_dict is never a duplicate, so no file is read again.
+
+    Groups that are nested inside a larger duplicate group are left out: if
+    every copy of a directory lies inside a directory that is itself
+    duplicated, only the outer group is reported. The roots themselves are
+    never reported.
+
+    Parameters:
+        checksum_dict (dict): Checksums mapped to lists of file paths, as
+            returned by organize_files_by_checksum().
+        roots (list): The directories that were scanned.
+
+    Returns:
+        list: DirectoryGroup records, largest subtrees first.
+    """
+    digests = {}
+    for checksum, file_group in checksum_dict.items():
+        for file in file_group:
+            digests[file] = checksum
+
+    tree_hashes = {}
+    by_hash = {}
+    for directory in _candidate_directories(checksum_dict, roots):
+        tree = _hash_directory(directory, digests, tree_hashes)
+        # Trees without files hold nothing worth reporting
+        if tree is not None and tree[2] > 0:
+            by_hash.setdefault(tree, []).append(directory)
+
+    duplicated = {directory for directories in by_hash.values() if len(directories) > 1
+                  for directory in directories}
+    groups = []
+    for (tree_hash, size, file_count), directories in by_hash.items():
+        if len(directories) < 2:
+            continue
+        if all(os.path.dirname(directory) in duplicated for directory in directories):
+            continue  # Covered by the group of the parent directories
+        groups.append(DirectoryGroup(tree_hash, size, file_count, sorted(directories)))
+    groups.sort(key=lambda group: (-group.size, -group.file_count, group.directories))
+    return groups
@@ -0,0 +1,402 @@
+# Watches directories with inotify and handles duplicates of new files as they arrive (Linux only).
+
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+from collections import namedtuple
+from functools import partial
+from file_handler import walk_files, stat_file, generate_checksum, hash_files, is_trash_directory, DEFAULT_WORKERS
+from ddas import build_removal_plan, execute_removal_plan
+
+# Initialize logger
+logger = logging.getLogger('DuplicationRemover')
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Events followed for every watched directory
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# struct inotify_event without its variable-length name
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds a file must stay untouched before it is hashed
+DEFAULT_DEBOUNCE = 2.0
+
+InotifyEvent = namedtuple('InotifyEvent', ['wd', 'mask', 'cookie', 'name'])
+
+class Inotify:
+    """
+    Minimal ctypes wrapper around the Linux inotify API.
+
+    Raises OSError if inotify is not available on this system.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = self._check(self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _check(result, path=None):
+        if result == -1:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return result
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a directory and return its watch descriptor (the same one if it is already watched)."""
+        return self._check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask), path)
+
+    def remove_watch(self, wd):
+        """Stop watching a watch descriptor. Watches that are already gone are ignored."""
+        try:
+            self._check(self._libc.inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+
+    def read_events(self, timeout=None):
+        """Wait up to timeout seconds for events and return all that are queued."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """Close the inotify file descriptor, which removes all watches."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class DuplicateWatcher:
+    """
+    Keeps a size -> digest index of the watched trees up to date from inotify events.
+
+    At start the roots are walked once, without reading any file. After that,
+    a file that is created, written, or moved into a root is handled once it
+    has been untouched for debounce seconds. It is hashed only if another file
+    of the same size exists; files of that size that have no digest yet are
+    hashed at the same time. Digests are remembered by (device, inode), so
+    renamed files are not hashed again, and they are also taken from and
+    stored in the ChecksumIndex if one is given.
+
+    A file whose content matches an existing file is reported to on_duplicate
+    as on_duplicate(checksum, size, paths, removed). If deletion_mode is set,
+    it is then handled through the removal engine. The existing files are
+    listed first, so the "first" keep policy keeps them; unless the keep
+    policy picks the new arrival, only the new arrival is removed.
+
+    If the kernel's event queue overflows, events have been lost. In that case
+    the roots are walked again and only new or changed files are queued.
+    """
+
+    def __init__(self, roots, deletion_mode=None, keep="first", preferred_root=None, index=None,
+                 algorithm="md5", debounce=DEFAULT_DEBOUNCE, exclude_dirs=(), min_size=0,
+                 workers=DEFAULT_WORKERS, on_duplicate=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.deletion_mode = deletion_mode
+        self.keep = keep
+        self.preferred_root = preferred_root
+        self.index = index
+        self.debounce = debounce
+        self.min_size = min_size
+        self.workers = workers
+        self.on_duplicate = on_duplicate
+        self._checksum = partial(generate_checksum, algorithm=algorithm)
+        self.exclude_dirs = list(exclude_dirs)
+
+        self.inotify = None
+        self._watches = {}      # wd -> directory
+        self._watched = {}      # directory -> wd
+        self._subdirectories = {}   # directory -> set of watched subdirectories
+        self._files = {}        # path -> FileEntry
+        self._directory_files = {}  # directory -> set of paths in _files
+        self._sizes = {}        # size -> set of paths
+        self._digests = {}      # (dev, inode) -> (size, mtime_ns, ctime_ns, digest)
+        self._linked = set()    # (dev, inode) of files created by link mode, never reported again
+        self._pending = {}      # path -> time of the last event
+        self.duplicates_found = 0
+        self.duplicates_removed = 0
+        self.removal_errors = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _watch_directory(self, path):
+        try:
+            wd = self.inotify.add_watch(path)
+            self._watches[wd] = path
+            self._watched[path] = wd
+            parent = os.path.dirname(path)
+            if parent in self._watched:
+                self._subdirectories.setdefault(parent, set()).add(path)
+        except OSError as e:
+            logger.error(f"Cannot watch {path}: {e}")
+            if e.errno == errno.ENOSPC:
+                logger.error("Raise fs.inotify.max_user_watches to watch more directories.")
+
+    def _add_tree(self, directory, queue_files):
+        """Watch a directory and its subdirectories, and index or queue the files found in them."""
+        now = time.monotonic()
+        for entry in walk_files(directory, self.exclude_dirs, self.min_size, on_directory=self._watch_directory):
+            if queue_files:
+                self._pending[entry.path] = now
+            else:
+                self._add_file(entry)
+
+    def _add_file(self, entry):
+        self._files[entry.path] = entry
+        self._sizes.setdefault(entry.size, set()).add(entry.path)
+        self._directory_files.setdefault(os.path.dirname(entry.path), set()).add(entry.path)
+
+    def _drop_file(self, path, forget_digest=False):
+        entry = self._files.pop(path, None)
+        if entry is None:
+            return
+        size_group = self._sizes.get(entry.size)
+        if size_group is not None:
+            size_group.discard(path)
+            if not size_group:
+                del self._sizes[entry.size]
+        directory_files = self._directory_files.get(os.path.dirname(path))
+        if directory_files is not None:
+            directory_files.discard(path)
+            if not directory_files:
+                del self._directory_files[os.path.dirname(path)]
+        if forget_digest:
+            self._digests.pop((entry.dev, entry.inode), None)
+
+    def _drop_tree(self, directory, forget_digests=False):
+        """
+        Forget every file and watch below a directory that was moved away or deleted.
+
+        Only the directories of the subtree are visited. Queued paths below it
+        are left in _pending; they no longer exist when their turn comes and
+        are skipped then.
+        """
+        siblings = self._subdirectories.get(os.path.dirname(directory))
+        if siblings is not None:
+            siblings.discard(directory)
+            if not siblings:
+                del self._subdirectories[os.path.dirname(directory)]
+        subtree = [directory]
+        while subtree:
+            current = subtree.pop()
+            for path in self._directory_files.pop(current, ()):
+                self._drop_file(path, forget_digests)
+            subtree.extend(self._subdirectories.pop(current, ()))
+            wd = self._watched.pop(current, None)
+            if wd is not None and self._watches.get(wd) == current:
+                self.inotify.remove_watch(wd)
+                del self._watches[wd]
+
+    def _cached_digest(self, entry):
+        cached = self._digests.get((entry.dev, entry.inode))
+        if cached is not None and cached[:3] == (entry.size, entry.mtime_ns, entry.ctime_ns):
+            return cached[3]
+        if self.index is not None:
+            full = self.index.lookup(entry)[1]
+            if full is not None:
+                self._digests[(entry.dev, entry.inode)] = (entry.size, entry.mtime_ns, entry.ctime_ns, full)
+                return full
+        return None
+
+    def _digests_of(self, entries):
+        """Return the digests of several files, hashing only those without a cached digest."""
+        digests = {entry: self._cached_digest(entry) for entry in entries}
+        missing = [entry for entry, digest in digests.items() if digest is None]
+        if missing:
+            for entry, digest in zip(missing, hash_files(self._checksum, [entry.path for entry in missing],
+                                                         workers=self.workers)):
+                digests[entry] = digest
+                self._digests[(entry.dev, entry.inode)] = (entry.size, entry.mtime_ns, entry.ctime_ns, digest)
+            if self.index is not None:
+                self.index.store_many((entry, None, digests[entry]) for entry in missing)
+        return digests
+
+    def start(self):
+        """Open inotify and walk the roots once."""
+        self.inotify = Inotify()
+        for root in self.roots:
+            self._add_tree(root, queue_files=False)
+        logger.info(f"Watching {len(self._watches)} directories with {len(self._files)} files")
+
+    def rescan(self):
+        """Walk the roots again after lost events, queueing only new or changed files."""
+        logger.info("inotify event queue overflowed, rescanning the watched directories")
+        seen = set()
+        now = time.monotonic()
+        for root in self.roots:
+            for entry in walk_files(root, self.exclude_dirs, self.min_size, on_directory=self._watch_directory):
+                seen.add(entry.path)
+                if self._files.get(entry.path) != entry:
+                    self._pending[entry.path] = now
+        for path in [path for path in self._files if path not in seen]:
+            self._drop_file(path, forget_digest=True)
+
+    def _handle_event(self, event):
+        if event.mask & IN_Q_OVERFLOW:
+            self.rescan()
+            return
+        directory = self._watches.get(event.wd)
+        if event.mask & IN_IGNORED:
+            self._watches.pop(event.wd, None)
+            if directory is not None and self._watched.get(directory) == event.wd:
+                del self._watched[directory]
+            return
+        if directory is None or not event.name:
+            return  # Events about the watched directory itself are handled through its parent
+        path = os.path.join(directory, event.name)
+
+        if event.mask & IN_ISDIR:
+            if event.mask & (IN_DELETE | IN_MOVED_FROM):
+                # Files moved away with their directory keep their inodes and ctimes, so their digests are kept
+                self._drop_tree(path, forget_digests=bool(event.mask & IN_DELETE))
+            elif (event.mask & (IN_CREATE | IN_MOVED_TO) and event.name not in self.exclude_dirs
+                  and not is_trash_directory(path)):
+                # Files may already exist in a directory that was just created or moved in
+                self._add_tree(path, queue_files=True)
+        elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+            # A file moved away keeps its inode, so its digest is kept for when it shows up again
+            self._drop_file(path, forget_digest=bool(event.mask & IN_DELETE))
+            self._pending.pop(path, None)
+        elif event.mask & (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._pending[path] = time.monotonic()
+
+    def _process_file(self, path):
+        """Index a file that has settled and report it if it duplicates an existing file."""
+        self._drop_file(path)
+        try:
+            entry = stat_file(path)
+        except OSError:
+            return
+        if not os.path.isfile(path) or os.path.islink(path) or entry.size < self.min_size:
+            return
+        others = [self._files[other] for other in self._sizes.get(entry.size, ())]
+        self._add_file(entry)
+        # Other names of the same inode are not duplicates
+        others = [other for other in others if (other.dev, other.inode) != (entry.dev, entry.inode)]
+        if not others or (entry.dev, entry.inode) in self._linked:
+            return
+
+        try:
+            digests = self._digests_of(others + [entry])
+        except OSError as e:
+            logger.error(f"Error hashing files of {entry.size} bytes: {e}")
+            return
+        matches = [other.path for other in others if digests[other] == digests[entry]]
+        if matches:
+            self._handle_duplicate(digests[entry], entry, sorted(matches))
+
+    def _handle_duplicate(self, checksum, entry, matches):
+        group = matches + [entry.path]
+        self.duplicates_found += 1
+        logger.info(f"New duplicate: {entry.path} has the same content as {matches[0]}")
+        removed = 0
+        if self.deletion_mode is not None:
+            plan = build_removal_plan({checksum: group}, self.keep, self.preferred_root)
+            if plan and plan[0].keep != entry.path:
+                # Files that were already there are left alone; only the new arrival is removed
+                plan = [group_plan._replace(remove=[entry.path]) for group_plan in plan
+                        if entry.path in group_plan.remove]
+            removed, errors = execute_removal_plan(plan, self.deletion_mode, workers=1)
+            self.duplicates_removed += removed
+            self.removal_errors += errors
+            if self.deletion_mode == "link":
+                # A reflink is a new inode with the same content; do not report it again
+                for group_plan in plan:
+                    for duplicate in group_plan.remove:
+                        try:
+                            linked = os.stat(duplicate)
+                            self._linked.add((linked.st_dev, linked.st_ino))
+                        except OSError:
+                            continue
+        if self.on_duplicate is not None:
+            self.on_duplicate(checksum, entry.size, group, removed)
+
+    def _process_pending(self):
+        """Handle the files that have been quiet for at least the debounce delay."""
+        now = time.monotonic()
+        ready = [path for path, last_event in self._pending.items() if now - last_event >= self.debounce]
+        for path in ready:
+            del self._pending[path]
+            self._process_file(path)
+
+    def _next_timeout(self):
+        if not self._pending:
+            return 1.0
+        return max(0.0, min(self._pending.values()) + self.debounce - time.monotonic())
+
+    def run(self, stop=None):
+        """
+        Watch until stop (a threading.Event) is set, or forever.
+
+        Raises OSError if inotify is not available.
+        """
+        if self.inotify is None:
+            self.start()
+        while stop is None or not stop.is_set():
+            for event in self.inotify.read_events(self._next_timeout()):
+                self._handle_event(event)
+            self._process_pending()
+
+    def close(self):
+        """Stop watching."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None